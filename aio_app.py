@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+ManyBot KZ - async серверлік режим (aiohttp, aiogram-мен бірге орнатылады)
+
+Serves the same webhook routes as main.py on an event loop:
+
+    gunicorn aio_app:app --worker-class aiohttp.GunicornWebWorker
+
+Storage and the command handlers run on a thread pool (asyncio.to_thread); the
+replies they produce are collected in an outbox and sent over one shared
+aiohttp session (the last one inline in the webhook response, as in main.py),
+so a worker waiting on Telegram does not hold a thread.
+`gunicorn main:app` keeps working unchanged.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any
+
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector
+
+import main
+
+logger = logging.getLogger("manybot.aio")
+
+AIO_STORAGE_THREADS = int(os.getenv("AIO_STORAGE_THREADS", "64"))  # threads for storage/handler work
+
+SESSION = web.AppKey("session", ClientSession)
+
+async def tg_call(session: ClientSession, token: str, method: str,
+                  payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Async twin of TelegramClient.call; errors come back as {"ok": False, "error": ...}."""
+    chat_id = (payload or {}).get("chat_id")
+    waited = 0.0
+    while chat_id is not None:  # same loop as BotRateLimiter.acquire, sleeping on the event loop
+        wait = await asyncio.to_thread(main.bot_limits.take, token, chat_id)
+        if wait <= 0:
+            break
+        if waited + wait > main.TG_MAX_WAIT:
+            logger.warning("Telegram %s to %s held back by the rate limit (%.1fs)", method, chat_id, wait)
+            return main.local_throttled(wait)
+        await asyncio.sleep(wait)
+        waited += wait
+    started = time.perf_counter()
+    outcome = "network"
+    try:
+        async with session.post(main.telegram_api_url(token, method), json=payload or {}) as r:
+            res = await r.json(content_type=None)
+            if res.get("error_code") == 429:
+                await asyncio.to_thread(main.bot_limits.feedback, token, res)
+            outcome = "ok" if res.get("ok") else str(res.get("error_code", "error"))
+            return res
+    except Exception as e:
+        logger.exception("Telegram %s error: %s", method, e)
+        return {"ok": False, "error": str(e)}
+    finally:
+        main.TELEGRAM_SECONDS.labels(method, outcome).observe(time.perf_counter() - started)
+
+async def send_outbox(session: ClientSession, outbox: main.Outbox):
+    # in order: the replies to one update must not overtake each other
+    for token, method, payload in outbox:
+        await tg_call(session, token, method, payload)
+
+async def _answer(request: web.Request, token: str, outbox: main.Outbox,
+                  body: Dict[str, Any], status: int) -> web.Response:
+    # same rules as main.answer_webhook: the last reply may ride on the response;
+    # split_inline_reply takes a rate-limit slot from SQLite, so it runs off the loop
+    if status == 200:
+        rest, inline = await asyncio.to_thread(main.split_inline_reply, outbox, token)
+    else:
+        rest, inline = outbox, None
+    await send_outbox(request.app[SESSION], rest)
+    return web.json_response(inline or body, status=status)
+
+async def _read_update(request: web.Request) -> Optional[dict]:
+    try:
+        update = await request.json()
+    except Exception:
+        return None
+    return update if isinstance(update, dict) else None
+
+async def root(request: web.Request) -> web.Response:
+    return web.Response(text="✅ ManyBot KZ running")
+
+async def metrics(request: web.Request) -> web.Response:
+    if not main.metrics_allowed(request.headers.get("Authorization")):
+        return web.Response(status=403, text="forbidden")
+    data = await asyncio.to_thread(main.render_metrics)
+    if data is None:
+        return web.Response(status=501, text="prometheus_client is not installed")
+    return web.Response(body=data, headers={"Content-Type": main.CONTENT_TYPE_LATEST})
+
+async def main_bot_webhook(request: web.Request) -> web.Response:
+    update = await _read_update(request)
+    if not update:
+        return web.json_response({"ok": False, "error": "invalid json"}, status=400)
+    outbox: main.Outbox = []
+    body, status = await asyncio.to_thread(main.process_main_update, update, outbox)
+    return await _answer(request, main.BOT_TOKEN, outbox, body, status)
+
+async def _user_bot_webhook(request: web.Request, bot_key: Optional[str], owner_bot: Optional[str]) -> web.Response:
+    secret = request.headers.get(main.SECRET_HEADER)
+    key, rec, err = await asyncio.to_thread(main.resolve_user_bot, bot_key, owner_bot, secret)
+    if err:
+        return web.json_response(err[0], status=err[1])
+    update = await _read_update(request)
+    if not update:
+        return web.json_response({"ok": False, "error": "invalid json"}, status=400)
+    outbox: main.Outbox = []
+    body, status = await asyncio.to_thread(main.process_user_bot_update, key, rec, update, outbox)
+    token = outbox[-1][0] if outbox else ""
+    return await _answer(request, token, outbox, body, status)
+
+async def user_bot_keyed_webhook(request: web.Request) -> web.Response:
+    return await _user_bot_webhook(request, request.match_info["bot_key"], None)
+
+async def user_bot_webhook(request: web.Request) -> web.Response:
+    return await _user_bot_webhook(request, None, request.match_info["owner_bot"])
+
+async def _on_startup(app: web.Application):
+    main.start_background_work()
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=AIO_STORAGE_THREADS, thread_name_prefix="aio-storage"))
+    app[SESSION] = ClientSession(
+        timeout=ClientTimeout(total=main.TELEGRAM_TIMEOUT),
+        connector=TCPConnector(limit=main.TELEGRAM_POOL_SIZE),
+    )
+
+async def _on_cleanup(app: web.Application):
+    await app[SESSION].close()
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get("/", root)
+    app.router.add_get("/metrics", metrics)
+    app.router.add_post(f"/{main.BOT_TOKEN}", main_bot_webhook)
+    app.router.add_post("/b/{bot_key}", user_bot_keyed_webhook)
+    app.router.add_post("/u/{owner_bot}", user_bot_webhook)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    return app
+
+app = create_app()
+
+if __name__ == "__main__":
+    main.ensure_main_webhook()
+    web.run_app(app, host="0.0.0.0", port=main.PORT)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+ManyBot KZ - офлайн жүктеме тесті (fake Telegram API)
+
+Starts a local fake Bot API server, points main.py at it (TELEGRAM_API_BASE),
+seeds the SQLite backend with N bots and N subscribers for each scale, then:
+
+  * replays synthetic updates against main_bot_webhook and user_bot_webhook
+    from a thread pool (p50/p99 latency, requests/sec);
+  * runs one broadcast job to N subscribers (msgs/sec).
+
+Scales grow in place (1k -> 10k -> 100k by default). Results go to a JSON file
+so runs can be compared over time:
+
+    python bench.py --scales 1000,10000 --latency-ms 30 --throttle-every 500
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Any, List
+
+BENCH_TOKEN = "100:BENCH"  # main bot token used for the run
+
+class FakeTelegram(ThreadingHTTPServer):
+    """Bot API stand-in: fixed latency, and a 429 on every `throttle_every`-th call."""
+
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.0, throttle_every: int = 0, retry_after: int = 1):
+        super().__init__(("127.0.0.1", 0), _FakeTelegramHandler)
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.calls: Dict[str, int] = {}
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, token: str, method: str) -> bool:
+        """Record a call; True if it should be answered with 429."""
+        with self._lock:
+            key = f"{token}/{method}"
+            self.calls[key] = n = self.calls.get(key, 0) + 1
+            if self.throttle_every and n % self.throttle_every == 0:
+                self.throttled += 1
+                return True
+        return False
+
+class _FakeTelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+
+    def do_POST(self):
+        server: FakeTelegram = self.server
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        _, bot, method = self.path.split("/", 2)
+        token = bot[3:]
+        if server.latency:
+            time.sleep(server.latency)
+        if server.count(token, method):
+            body = {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                    "parameters": {"retry_after": server.retry_after}}
+        elif method == "getMe":
+            body = {"ok": True, "result": {"id": int(token.split(":")[0]), "is_bot": True, "username": "bench_bot"}}
+        elif method == "getWebhookInfo":
+            body = {"ok": True, "result": {"url": "", "pending_update_count": 0}}
+        else:
+            body = {"ok": True, "result": {"message_id": 1}}
+        data = json.dumps(body).encode()
+        self.send_response(429 if body.get("error_code") == 429 else 200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def seed(main, bots: int, have: int):
+    """Grow the bots table to `bots` rows (bot 0 is the broadcast bot) and give bot 0 as many subscribers."""
+    rows = []
+    for i in range(have, bots):
+        rec = {"owner": 1 + i % 1000, "bot_id": 10_000 + i, "username": f"bench{i}", "token": f"{10_000 + i}:BENCH",
+               "description": "", "autopost_enabled": False, "bot_lang": "kk", "created_at": int(time.time())}
+        rows.append((f"bench{i:08d}", rec["owner"], rec["bot_id"], json.dumps(rec)))
+    with main.local_tx() as c:
+        c.executemany("INSERT OR IGNORE INTO bots (key, owner, bot_id, data) VALUES (?, ?, ?, ?)", rows)
+    for start in range(have, bots, 10_000):
+        main.add_subscribers_bulk([("bench00000000", uid) for uid in range(start + 1, min(bots, start + 10_000) + 1)])
+
+def replay(app, requests: List[tuple], concurrency: int) -> Dict[str, Any]:
+    """POST (path, json, headers) tuples concurrently; returns latency percentiles and throughput."""
+    local = threading.local()
+    latencies: List[float] = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(req):
+        nonlocal errors
+        client = getattr(local, "client", None) or app.test_client()
+        local.client = client
+        path, body, headers = req
+        started = time.perf_counter()
+        r = client.post(path, json=body, headers=headers)
+        took = time.perf_counter() - started
+        with lock:
+            latencies.append(took)
+            if r.status_code != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, requests))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(requests),
+        "errors": errors,
+        "rps": round(len(requests) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+def main_updates(n: int, first_id: int) -> List[tuple]:
+    texts = ["/start", "/help", "/bots", "/subscribers", "/lang", "/templates"]
+    out = []
+    for i in range(n):
+        uid = 1 + random.randrange(1000)
+        msg = {"message_id": i, "chat": {"id": uid, "type": "private"}, "from": {"id": uid},
+               "text": random.choice(texts)}
+        out.append((f"/{BENCH_TOKEN}", {"update_id": first_id + i, "message": msg}, {}))
+    return out
+
+def user_updates(main, n: int, bots: int, first_id: int) -> List[tuple]:
+    out = []
+    for i in range(n):
+        key = f"bench{random.randrange(bots):08d}"
+        chat = 5_000_000 + first_id + i
+        msg = {"message_id": i, "chat": {"id": chat, "type": "private"}, "from": {"id": chat}, "text": "/start"}
+        out.append((f"/b/{key}", {"update_id": first_id + i, "message": msg},
+                    {main.SECRET_HEADER: main.webhook_secret(key)}))
+    return out
+
+def run_broadcast(main, fake: FakeTelegram) -> Dict[str, Any]:
+    key = "bench00000000"
+    rec = main.get_bot_by_key(key)
+    token = rec["token"]
+    before = fake.calls.get(f"{token}/sendMessage", 0)
+    throttled_before = fake.throttled
+    job_key = f"bench_{time.time_ns()}"
+    main.enqueue_broadcast(job_key, key, 1, "bench")
+    claimed = main.claim_broadcast_job()
+    started = time.perf_counter()
+    main.run_broadcast_job(*claimed)
+    elapsed = time.perf_counter() - started
+    sent = fake.calls.get(f"{token}/sendMessage", 0) - before
+    return {
+        "subscribers": main.count_subscribers(key),
+        "api_calls": sent,
+        "throttled": fake.throttled - throttled_before,
+        "elapsed": round(elapsed, 2),
+        "msgs_per_sec": round(sent / elapsed, 1) if elapsed else 0.0,
+    }
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)), text=True).strip()
+    except Exception:
+        return ""
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Offline ManyBot KZ benchmark against a fake Bot API.")
+    p.add_argument("--scales", default="1000,10000,100000", help="bot/subscriber counts, comma-separated")
+    p.add_argument("--requests", type=int, default=2000, help="updates replayed per webhook and scale")
+    p.add_argument("--concurrency", type=int, default=32)
+    p.add_argument("--latency-ms", type=float, default=20.0, help="fake Bot API latency")
+    p.add_argument("--throttle-every", type=int, default=0, help="answer every Nth call per token/method with 429")
+    p.add_argument("--retry-after", type=int, default=1)
+    p.add_argument("--broadcast-rate", default="0", help="BROADCAST_RATE for the run (0 = unlimited)")
+    p.add_argument("--tg-limits", action="store_true", help="keep the per-bot/per-chat Bot API limits on")
+    p.add_argument("--no-inline", action="store_true", help="send replies through the API instead of inline")
+    p.add_argument("--db-dir", default=None, help="SQLite directory (default: a fresh temp dir)")
+    p.add_argument("--out", default=None, help="result file (default: bench-results/<timestamp>.json)")
+    return p.parse_args(argv)
+
+def run(argv=None) -> Dict[str, Any]:
+    args = parse_args(argv)
+    scales = sorted(int(s) for s in args.scales.split(",") if s.strip())
+    fake = FakeTelegram(args.latency_ms / 1000.0, args.throttle_every, args.retry_after)
+    threading.Thread(target=fake.serve_forever, name="fake-telegram", daemon=True).start()
+
+    # main.py reads its configuration at import
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "TELEGRAM_API_BASE": fake.base_url,
+        "LOCAL_DB_DIR": args.db_dir or tempfile.mkdtemp(prefix="manybot-bench-"),
+        "FIREBASE_ENABLED": "0",
+        "BROADCAST_WORKER_MODE": "external",
+        "AUTOPOST_MODE": "off",
+        "BROADCAST_RATE": args.broadcast_rate,
+        "WEBHOOK_INLINE_REPLY": "0" if args.no_inline else "1",
+    })
+    if not args.tg_limits:
+        os.environ.update({"TG_BOT_RATE": "0", "TG_PRIVATE_RATE": "0", "TG_GROUP_PER_MINUTE": "0"})
+    os.environ.pop("WEBHOOK_BASE_URL", None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    logging.disable(logging.INFO)
+    import main
+
+    results: Dict[str, Any] = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": git_revision(),
+        "params": {k: v for k, v in vars(args).items() if k != "out"},
+        "scales": [],
+    }
+    have, next_id = 0, 1
+    for n in scales:
+        t0 = time.perf_counter()
+        seed(main, n, have)
+        have = n
+        row: Dict[str, Any] = {"bots": n, "seed_seconds": round(time.perf_counter() - t0, 2)}
+        row["main_webhook"] = replay(main.app, main_updates(args.requests, next_id), args.concurrency)
+        next_id += args.requests
+        row["user_webhook"] = replay(main.app, user_updates(main, args.requests, n, next_id), args.concurrency)
+        next_id += args.requests
+        main.subscriber_buffer.flush()
+        row["broadcast"] = run_broadcast(main, fake)
+        results["scales"].append(row)
+        print(json.dumps(row), flush=True)
+
+    out = args.out or os.path.join("bench-results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {out}")
+    fake.shutdown()
+    return results
+
+if __name__ == "__main__":
+    run()
@@ -1,30 +1,79 @@
 import os
 import json
-import firebase_admin
-from firebase_admin import credentials, db
+import logging
+import threading
 
-def initialize_firebase():
-    try:
-        print("🔄 Firebase байланысын тексеру...")
+logger = logging.getLogger("manybot_kz")
 
-        firebase_json = os.getenv("FIREBASE_SECRET")
-        if not firebase_json:
-            print("🚫 Firebase secret табылмады!")
-            return None, None
+_app = None
+_tried = False
+_lock = threading.Lock()
 
-        creds_dict = json.loads(firebase_json)
-        cred = credentials.Certificate(creds_dict)
+def load_firebase_creds():
+    # 1) ENV FIREBASE_SECRET (JSON string). May have escaped \\n in private_key.
+    s = os.getenv("FIREBASE_SECRET")
+    if s:
+        try:
+            if "\\n" in s:
+                s = s.replace("\\n", "\n")
+            parsed = json.loads(s)
+            return parsed
+        except Exception:
+            logger.exception("FIREBASE_SECRET ENV парсинг қатесі.")
+    # 2) file firebase_secret.json in repo
+    if os.path.exists("firebase_secret.json"):
+        try:
+            with open("firebase_secret.json", "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if "private_key" in data and "\\n" in data["private_key"]:
+                data["private_key"] = data["private_key"].replace("\\n", "\n")
+            return data
+        except Exception:
+            logger.exception("firebase_secret.json оқу қатесі.")
+    return None
 
-        # 🔥 Өз database URL-ыңды жаз:
-        firebase_admin.initialize_app(cred, {
-            "databaseURL": "https://manybot-kz-default-rtdb.firebaseio.com/"
-        })
+def get_firebase_app():
+    """Initialize the Firebase app on first use; returns it, or None if unavailable.
 
-        print("✅ Firebase сәтті қосылды!")
-        users_ref = db.reference("users")
-        memory_ref = db.reference("memory")
-        return users_ref, memory_ref
+    Safe to call from any thread; the initialization runs at most once per process.
+    firebase_admin itself is imported here too, as it is slow to import.
+    """
+    global _app, _tried
+    if _tried:
+        return _app
+    with _lock:
+        if _tried:
+            return _app
+        try:
+            if os.getenv("FIREBASE_ENABLED", "1") != "1":
+                logger.info("FIREBASE_ENABLED=0 — локал fallback пайдаланылады.")
+                return None
+            try:
+                import firebase_admin
+                from firebase_admin import credentials
+            except Exception:
+                logger.info("firebase_admin пакеті орнатылмаған — локал fallback пайдаланылады.")
+                return None
+            creds_dict = load_firebase_creds()
+            if not creds_dict:
+                logger.info("Firebase credentials табылмады — локал fallback пайдаланылады.")
+                return None
+            db_url = os.getenv("FIREBASE_DB_URL") or f"https://{creds_dict.get('project_id')}-default-rtdb.firebaseio.com/"
+            try:
+                _app = firebase_admin.get_app()
+            except ValueError:
+                _app = firebase_admin.initialize_app(credentials.Certificate(creds_dict), {"databaseURL": db_url})
+            logger.info("✅ Firebase инициализация сәтті: %s", db_url)
+        except Exception:
+            logger.exception("Firebase инициализация сәтсіз.")
+            _app = None
+        finally:
+            _tried = True
+    return _app
 
-    except Exception as e:
-        print(f"🚫 Firebase қатесі: {e}")
+def initialize_firebase():
+    """Old entry point: (users_ref, memory_ref), or (None, None) without Firebase."""
+    if get_firebase_app() is None:
         return None, None
+    from firebase_admin import db
+    return db.reference("users"), db.reference("memory")
@@ -0,0 +1,31 @@
+# gunicorn loads ./gunicorn.conf.py by default, for both `gunicorn main:app`
+# and `gunicorn aio_app:app --worker-class aiohttp.GunicornWebWorker`.
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+def on_starting(server):
+    # per-worker metric files from a previous run would be merged into /metrics
+    path = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "manybot-metrics"))
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+def when_ready(server):
+    # once per deploy instead of once per worker import; run out of process so the
+    # master never imports main (workers would inherit it, and HUP reloads with it)
+    try:
+        r = subprocess.run([sys.executable, "-m", "flask", "--app", "main", "set-webhook"],
+                           cwd=server.cfg.chdir, timeout=120)
+        if r.returncode:
+            server.log.error("flask set-webhook exited with %s", r.returncode)
+    except Exception:
+        server.log.exception("flask set-webhook failed")
+
+def child_exit(server, worker):
+    try:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+    except Exception:
+        pass
@@ -6,41 +6,162 @@ ManyBot KZ - Flask + Firebase версиясы
 """
 
 import os
+import re
+import itertools
+import functools
+import heapq
 import json
 import time
 import logging
+import logging.handlers
+import contextvars
+import queue
+import random
+import copy
 import traceback
 import uuid
-from typing import Optional, Dict, Any, List
+import hmac
+import hashlib
+import fcntl
+import tempfile
+import socket
+import sqlite3
+import atexit
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, List, Iterable, Iterator, Tuple
 
 from flask import Flask, request, jsonify
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Optional crypto
 try:
-    from cryptography.fernet import Fernet, InvalidToken
+    from cryptography.fernet import Fernet, MultiFernet, InvalidToken
     CRYPTO_AVAILABLE = True
 except Exception:
     CRYPTO_AVAILABLE = False
 
-# Firebase
-try:
-    import firebase_admin
-    from firebase_admin import credentials, db
-    FIREBASE_PY_AVAILABLE = True
-except Exception:
-    FIREBASE_PY_AVAILABLE = False
+from firebase_utils import get_firebase_app
 
 # ---------------- logging ----------------
-logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+# Records are handed to a queue and formatted/written by a listener thread, so a
+# slow stdout never stalls a webhook. Each record carries the fields of the
+# update being handled (request_id, bot, command, ...) from a contextvar, and
+# LOG_SAMPLE thins out chatty levels before anything is queued.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")          # json | text
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_PAYLOAD_CHARS = int(os.getenv("LOG_PAYLOAD_CHARS", "300"))
+
+def _parse_log_sample(spec: str) -> Dict[int, float]:
+    """"INFO=0.1,DEBUG=0" -> {20: 0.1, 10: 0.0}; levels not listed are always kept."""
+    rates = {}
+    for part in spec.split(","):
+        name, _, rate = part.partition("=")
+        level = logging.getLevelName(name.strip().upper())
+        if isinstance(level, int) and rate.strip():
+            rates[level] = max(0.0, min(1.0, float(rate)))
+    return rates
+
+LOG_SAMPLE = _parse_log_sample(os.getenv("LOG_SAMPLE", ""))  # e.g. INFO=0.1 keeps ~10% of info lines
+
+_log_context: contextvars.ContextVar = contextvars.ContextVar("log_context", default={})
+_LOG_FIELDS = ("request_id", "bot", "command", "update_id", "duration_ms")
+
+@contextmanager
+def log_context(**fields):
+    """Attach `fields` to every record logged inside the block (current thread or task only)."""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+class LazyJson:
+    """Log argument serialized only when the record is written: logger.info("x: %s", LazyJson(obj))."""
+    __slots__ = ("obj", "limit")
+
+    def __init__(self, obj, limit: int = LOG_PAYLOAD_CHARS):
+        self.obj = obj
+        self.limit = limit
+
+    def __str__(self):
+        try:
+            return json.dumps(self.obj, ensure_ascii=False, default=str)[:self.limit]
+        except Exception:
+            return repr(self.obj)[:self.limit]
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in _LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _SampleFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = LOG_SAMPLE.get(record.levelno)
+        return rate is None or random.random() < rate
+
+_LOG_SCALARS = (str, int, float, bool, type(None), LazyJson)
+
+class _ContextQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # unlike the stock handler, leave formatting of scalar and LazyJson args to the
+        # listener; anything mutable is formatted now, before the caller can change it
+        record = copy.copy(record)
+        # (a lone dict argument ends up as record.args itself, so a mapping is always eager)
+        args = record.args
+        if args and (isinstance(args, dict) or not all(isinstance(a, _LOG_SCALARS) for a in args)):
+            record.msg, record.args = record.getMessage(), None
+        record.__dict__.update(_log_context.get())
+        return record
+
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(JsonFormatter() if LOG_FORMAT == "json"
+                         else logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+_log_handler = _ContextQueueHandler(queue.SimpleQueue())
+_log_handler.addFilter(_SampleFilter())
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+def _start_log_listener():
+    # also run in forked children (gunicorn workers): the parent's listener thread does not survive fork
+    global _log_listener
+    _log_handler.queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(_log_handler.queue, _log_output, respect_handler_level=True)
+    _log_listener.start()
+
+def _stop_log_listener():
+    if _log_listener:
+        _log_listener.stop()  # drains what is still queued
+
+if not logging.getLogger().handlers:  # like basicConfig: leave an embedding app's setup alone
+    logging.getLogger().setLevel(LOG_LEVEL)
+    logging.getLogger().addHandler(_log_handler)
+    _start_log_listener()
+    atexit.register(_stop_log_listener)
+    os.register_at_fork(after_in_child=_start_log_listener)
 logger = logging.getLogger("manybot_kz")
+_IMPORT_STARTED = time.perf_counter()
 
 # ---------------- config from ENV ----------------
 BOT_TOKEN = os.getenv("BOT_TOKEN")                 # main ManyBot token (BotFather)
 WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL")   # e.g. https://yourapp.onrender.com
 PORT = int(os.getenv("PORT", "10000"))
-MASTER_KEY = os.getenv("MASTER_KEY")               # optional Fernet key (base64)
-FIREBASE_DB_URL_ENV = os.getenv("FIREBASE_DB_URL") # optional override
+MASTER_KEY = os.getenv("MASTER_KEY")               # optional Fernet key(s), comma-separated, newest first
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or BOT_TOKEN or ""  # signs user-bot webhook secret tokens
 
 # Warnings for missing but continue (we'll still run, but limited)
 if not BOT_TOKEN:
@@ -55,102 +176,535 @@ if MASTER_KEY:
         logger.warning("cryptography орнатылмаған — MASTER_KEY еленбейді.")
     else:
         try:
-            fernet = Fernet(MASTER_KEY.encode())
+            # several keys allow rotation: the first encrypts, all of them decrypt
+            fernet = MultiFernet([Fernet(k.strip().encode()) for k in MASTER_KEY.split(",") if k.strip()])
             logger.info("🔐 Fernet шифрлау қолжетімді.")
         except Exception:
             logger.exception("MASTER_KEY жарамсыз — Fernet құру сәтсіз.")
 
+# ---------------- Metrics (optional prometheus_client) ----------------
+# Workers write to METRICS_DIR and /metrics merges every worker's files, so the
+# numbers cover the whole gunicorn pool. prometheus_client reads the directory
+# from the environment at import, hence the setdefault before importing it.
+METRICS_DIR = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "manybot-metrics"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # optional bearer token for /metrics
+try:
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    from prometheus_client import Counter, Histogram, CollectorRegistry, generate_latest, multiprocess
+    from prometheus_client import CONTENT_TYPE_LATEST
+    PROMETHEUS_AVAILABLE = True
+except Exception:
+    PROMETHEUS_AVAILABLE = False
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value: float):
+        pass
+
+    def inc(self, amount: float = 1):
+        pass
+
+def _metric(kind, name: str, doc: str, labels: Tuple[str, ...]):
+    return kind(name, doc, labels) if PROMETHEUS_AVAILABLE else _NoopMetric()
+
+_LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+TELEGRAM_SECONDS = _metric(lambda n, d, l: Histogram(n, d, l, buckets=_LATENCY_BUCKETS),
+                           "manybot_telegram_request_seconds", "Bot API call latency", ("method", "outcome"))
+INLINE_REPLIES = _metric(Counter, "manybot_inline_replies_total", "Bot API calls answered in the webhook response", ("method",))
+STORAGE_SECONDS = _metric(lambda n, d, l: Histogram(n, d, l, buckets=_LATENCY_BUCKETS),
+                          "manybot_storage_seconds", "Storage helper latency", ("op", "backend"))
+STORAGE_FALLBACKS = _metric(Counter, "manybot_storage_fallbacks_total", "Firebase errors answered from SQLite", ("op",))
+WEBHOOK_SECONDS = _metric(lambda n, d, l: Histogram(n, d, l, buckets=_LATENCY_BUCKETS),
+                          "manybot_webhook_seconds", "Webhook update handling time", ("bot", "command"))
+BROADCAST_MESSAGES = _metric(Counter, "manybot_broadcast_messages_total", "Broadcast deliveries by outcome", ("outcome",))
+
+_storage_call = threading.local()
+
+def storage_op(fn, local_only: bool = False):
+    """Time a storage helper, labelled firebase or local (local also when it fell back)."""
+    op = fn.__name__.lstrip("_")
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        outer = getattr(_storage_call, "fell_back", None)
+        _storage_call.fell_back = False
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            backend = "firebase" if FIREBASE_OK and not local_only and not _storage_call.fell_back else "local"
+            STORAGE_SECONDS.labels(op, backend).observe(time.perf_counter() - started)
+            if _storage_call.fell_back:
+                STORAGE_FALLBACKS.labels(op).inc()
+            _storage_call.fell_back = outer
+    return wrapper
+
+def local_storage_op(fn):
+    """storage_op for helpers that only ever use the SQLite store."""
+    return storage_op(fn, local_only=True)
+
+def note_storage_fallback():
+    """Called from a storage helper's except block before it retries on SQLite."""
+    _storage_call.fell_back = True
+
+def render_metrics() -> Optional[bytes]:
+    if not PROMETHEUS_AVAILABLE:
+        return None
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=METRICS_DIR)
+    return generate_latest(registry)
+
+# ---------------- Bot API rate limits ----------------
+# Telegram allows ~30 msg/s per bot, ~1 msg/s per private chat and 20 msg/min per
+# group. The buckets live in the local SQLite DB, so every gunicorn worker draws
+# from the same ones, and a 429's retry_after is written back into the bot's bucket.
+TG_BOT_RATE = float(os.getenv("TG_BOT_RATE", "30"))                 # msgs/sec per bot (0 = off)
+TG_BOT_BURST = int(os.getenv("TG_BOT_BURST", "10"))
+TG_PRIVATE_RATE = float(os.getenv("TG_PRIVATE_RATE", "1"))          # msgs/sec per private chat
+TG_GROUP_RATE = float(os.getenv("TG_GROUP_PER_MINUTE", "20")) / 60  # per group/channel
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "3"))                # back-to-back sends per chat
+TG_MAX_WAIT = float(os.getenv("TG_MAX_WAIT", "20"))  # longer waits get a local 429 instead of a sleep
+
+def _retry_after(res: Dict[str, Any]) -> Optional[float]:
+    if res.get("error_code") != 429:
+        return None
+    params = res.get("parameters") or {}
+    return float(params.get("retry_after") or 1)
+
+def local_throttled(wait: float) -> Dict[str, Any]:
+    """Result for a call refused by BotRateLimiter; shaped like Telegram's own 429."""
+    return {"ok": False, "error_code": 429, "description": "Too Many Requests: local rate limit",
+            "parameters": {"retry_after": max(1, int(wait + 0.999))}}
+
+class BotRateLimiter:
+    """Token buckets per bot and per chat, shared across processes.
+
+    Each bucket is stored as a GCRA "theoretical arrival time", which behaves
+    like a bucket of `burst` tokens refilled at `rate` but takes a single row
+    update. A send takes a token from its bot's and its chat's buckets together,
+    in one transaction; if either is empty the caller sleeps and tries again.
+    """
+
+    def __init__(self):
+        self._pruned_at = 0.0
+
+    @staticmethod
+    def _buckets(token: str, chat_id) -> List[Tuple[str, float, float]]:
+        """(key, interval, tolerance) for each bucket a send to `chat_id` draws from."""
+        bot = token.split(":", 1)[0]  # the bot id; the secret part never reaches the DB
+        specs = [(f"bot:{bot}", TG_BOT_RATE, TG_BOT_BURST)]
+        if chat_id is not None:
+            group = isinstance(chat_id, str) or int(chat_id) < 0  # "@channel" or a negative group id
+            specs.append((f"chat:{bot}:{chat_id}", TG_GROUP_RATE if group else TG_PRIVATE_RATE, TG_CHAT_BURST))
+        return [(k, 1.0 / rate, (max(burst, 1) - 1) / rate) for k, rate, burst in specs if rate > 0]
+
+    def take(self, token: str, chat_id) -> float:
+        """Take a token from each bucket if all have one; else return the seconds until they will."""
+        buckets = self._buckets(token, chat_id)
+        if not buckets:
+            return 0.0
+        now = time.time()
+        try:
+            with local_tx() as c:
+                if now - self._pruned_at > 60:
+                    self._pruned_at = now
+                    c.execute("DELETE FROM rate_buckets WHERE tat < ?", (now,))  # full buckets need no row
+                keys = [k for k, _, _ in buckets]
+                tat = dict(c.execute(f"SELECT key, tat FROM rate_buckets WHERE key IN ({','.join('?' * len(keys))})",
+                                     keys).fetchall())
+                wait = max(tat.get(k, now) - tolerance - now for k, _, tolerance in buckets)
+                if wait > 0:
+                    return wait
+                c.executemany("INSERT OR REPLACE INTO rate_buckets (key, tat) VALUES (?, ?)",
+                              [(k, max(tat.get(k, now), now) + interval) for k, interval, _ in buckets])
+            return 0.0
+        except Exception:
+            # never hold messages back because the bucket store is unavailable
+            logger.exception("rate limiter unavailable")
+            return 0.0
+
+    def acquire(self, token: str, chat_id, max_wait: float = TG_MAX_WAIT) -> Optional[float]:
+        """Sleep until a send slot is taken. Returns None, or the wait if it would exceed `max_wait`."""
+        waited = 0.0
+        while True:
+            wait = self.take(token, chat_id)
+            if wait <= 0:
+                return None
+            if waited + wait > max_wait:
+                return wait
+            time.sleep(wait)
+            waited += wait
+
+    def feedback(self, token: str, res: Dict[str, Any]):
+        """Feed a 429's retry_after back: nothing is sent as this bot until it has passed."""
+        wait = _retry_after(res)
+        if wait is None or TG_BOT_RATE <= 0:
+            return
+        key = f"bot:{token.split(':', 1)[0]}"
+        # the bucket restarts empty after the pause, so sends resume at the steady rate
+        tat = time.time() + wait + (max(TG_BOT_BURST, 1) - 1) / TG_BOT_RATE
+        try:
+            local_db().execute("INSERT INTO rate_buckets (key, tat) VALUES (?, ?) "
+                               "ON CONFLICT (key) DO UPDATE SET tat = max(tat, excluded.tat)", (key, tat))
+        except Exception:
+            logger.exception("rate limiter feedback failed")
+
+bot_limits = BotRateLimiter()
+
 # Telegram helpers (requests)
+TELEGRAM_TIMEOUT = float(os.getenv("TELEGRAM_TIMEOUT", "8"))
+TELEGRAM_RETRIES = int(os.getenv("TELEGRAM_RETRIES", "2"))
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "32"))
+TELEGRAM_UPLOAD_TIMEOUT = float(os.getenv("TELEGRAM_UPLOAD_TIMEOUT", "120"))  # media downloads and uploads
+
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")  # e.g. a local Bot API server
+
 def telegram_api_url(token: str, method: str) -> str:
-    return f"https://api.telegram.org/bot{token}/{method}"
+    return f"{TELEGRAM_API_BASE}/bot{token}/{method}"
+
+class TelegramClient:
+    """Bot API client sharing one keep-alive connection pool across all tokens.
+
+    Retries only cover failures where the request never reached Telegram:
+    connect errors and 503 Service Unavailable. A 502 or 504 can come back after
+    Telegram already delivered the message, so those are not retried and a send
+    is never silently doubled.
+    """
+
+    def __init__(self, timeout: float = TELEGRAM_TIMEOUT, retries: int = TELEGRAM_RETRIES, pool_size: int = TELEGRAM_POOL_SIZE):
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(total=retries, connect=retries, read=0, status=retries,
+                      status_forcelist=(503,), allowed_methods=None,
+                      backoff_factor=0.3, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def call(self, token: str, method: str, payload: Optional[Dict[str, Any]] = None, timeout: Optional[float] = None,
+             files: Optional[Dict[str, Tuple[str, bytes]]] = None) -> Dict[str, Any]:
+        """POST a Bot API method; network errors are returned as {"ok": False, "error": ...}.
+
+        Calls addressed to a chat first wait for a slot in bot_limits. With
+        `files` the call is sent as multipart/form-data (an upload).
+        """
+        chat_id = (payload or {}).get("chat_id")
+        if chat_id is not None:
+            refused = bot_limits.acquire(token, chat_id)
+            if refused is not None:
+                logger.warning("Telegram %s to %s held back by the rate limit (%.1fs)", method, chat_id, refused)
+                return local_throttled(refused)
+        started = time.perf_counter()
+        outcome = "network"
+        try:
+            if files:
+                form = {k: json.dumps(v) if isinstance(v, (dict, list)) else str(v) for k, v in (payload or {}).items()}
+                r = self.session.post(telegram_api_url(token, method), data=form, files=files,
+                                      timeout=timeout or self.timeout)
+            else:
+                r = self.session.post(telegram_api_url(token, method), json=payload or {},
+                                      timeout=timeout or self.timeout)
+            res = r.json()
+            bot_limits.feedback(token, res)
+            outcome = "ok" if res.get("ok") else str(res.get("error_code", "error"))
+            return res
+        except Exception as e:
+            logger.exception("Telegram %s error: %s", method, e)
+            return {"ok": False, "error": str(e)}
+        finally:
+            TELEGRAM_SECONDS.labels(method, outcome).observe(time.perf_counter() - started)
+
+tg = TelegramClient()
 
 def send_message_with_token(token: str, chat_id: int, text: str, parse_mode: str="HTML") -> Dict[str, Any]:
+    return tg.call(token, "sendMessage", {"chat_id": chat_id, "text": text, "parse_mode": parse_mode})
+
+def send_main_message(chat_id: int, text: str, parse_mode: Optional[str] = None) -> Dict[str, Any]:
+    """Reply from the main ManyBot."""
+    payload = {"chat_id": chat_id, "text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    return tg.call(BOT_TOKEN, "sendMessage", payload)
+
+def download_file(token: str, file_id: str) -> Optional[Tuple[str, bytes]]:
+    """(file name, bytes) of a file the bot received; None if it cannot be fetched (over 20 MB on the cloud API)."""
+    res = tg.call(token, "getFile", {"file_id": file_id})
+    path = (res.get("result") or {}).get("file_path") if res.get("ok") else None
+    if not path:
+        logger.warning("getFile %s failed: %s", file_id, res.get("description") or res.get("error"))
+        return None
     try:
-        r = requests.post(telegram_api_url(token, "sendMessage"),
-                          json={"chat_id": chat_id, "text": text, "parse_mode": parse_mode},
-                          timeout=8)
-        return r.json()
-    except Exception as e:
-        logger.exception("send_message_with_token error: %s", e)
-        return {"ok": False, "error": str(e)}
-
-def get_me(token: str) -> Optional[Dict[str, Any]]:
-    try:
-        r = requests.get(telegram_api_url(token, "getMe"), timeout=8).json()
-        return r.get("result") if r.get("ok") else None
-    except Exception as e:
-        logger.exception("get_me error: %s", e)
+        r = tg.session.get(f"{TELEGRAM_API_BASE}/file/bot{token}/{path}", timeout=TELEGRAM_UPLOAD_TIMEOUT)
+        r.raise_for_status()
+        return os.path.basename(path), r.content
+    except Exception:
+        logger.exception("Downloading %s failed", path)
         return None
 
-def set_webhook_for_token(token: str, url: str) -> Dict[str, Any]:
-    try:
-        r = requests.post(telegram_api_url(token, "setWebhook"), json={"url": url}, timeout=8)
-        return r.json()
-    except Exception as e:
-        logger.exception("set_webhook_for_token error: %s", e)
-        return {"ok": False, "error": str(e)}
+def get_me(token: str) -> Optional[Dict[str, Any]]:
+    r = tg.call(token, "getMe")
+    return r.get("result") if r.get("ok") else None
+
+def set_webhook_for_token(token: str, url: str, secret_token: Optional[str] = None,
+                          allowed_updates: Optional[List[str]] = None) -> Dict[str, Any]:
+    payload = {"url": url}
+    if secret_token:
+        payload["secret_token"] = secret_token
+    if allowed_updates is not None:
+        payload["allowed_updates"] = allowed_updates
+    return tg.call(token, "setWebhook", payload)
 
 def delete_webhook_for_token(token: str) -> Dict[str, Any]:
-    try:
-        r = requests.post(telegram_api_url(token, "deleteWebhook"), timeout=8)
-        return r.json()
-    except Exception as e:
-        logger.exception("delete_webhook_for_token error: %s", e)
-        return {"ok": False, "error": str(e)}
-
-# ---------------- Firebase init (env or file) ----------------
-def load_firebase_creds() -> Optional[dict]:
-    # 1) ENV FIREBASE_SECRET (JSON string). May have escaped \\n in private_key.
-    s = os.getenv("FIREBASE_SECRET")
-    if s:
-        try:
-            if "\\n" in s:
-                s = s.replace("\\n", "\n")
-            parsed = json.loads(s)
-            return parsed
-        except Exception:
-            logger.exception("FIREBASE_SECRET ENV парсинг қатесі.")
-    # 2) file firebase_secret.json in repo
-    if os.path.exists("firebase_secret.json"):
-        try:
-            with open("firebase_secret.json", "r", encoding="utf-8") as f:
-                data = json.load(f)
-            if "private_key" in data and "\\n" in data["private_key"]:
-                data["private_key"] = data["private_key"].replace("\\n", "\n")
-            return data
-        except Exception:
-            logger.exception("firebase_secret.json оқу қатесі.")
-    return None
+    return tg.call(token, "deleteWebhook")
+
+# An outbox is a list of (token, method, payload) calls that the caller sends
+# itself once the update is processed (the async server does this on its loop).
+Outbox = List[Tuple[str, str, Dict[str, Any]]]
+
+def deliver(outbox: Optional[Outbox], token: str, method: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Call a Bot API method now, or queue it on `outbox` when one is given.
+
+    Queued calls report {"ok": True}; code that needs the real result calls tg directly.
+    """
+    if outbox is None:
+        return tg.call(token, method, payload)
+    outbox.append((token, method, payload))
+    return {"ok": True}
+
+# ---------------- Broadcast engine ----------------
+# Telegram allows ~30 msg/s per bot token; we aim a bit lower and hold it steady.
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))          # msgs/sec per bot
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "16"))      # parallel senders
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))  # retries after 429
+
+class RateLimiter:
+    """Thread-safe pacer handing out send slots at a fixed rate.
+
+    A 429 `retry_after` pauses every sender sharing the limiter, not just the
+    one that got throttled.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+# Delivery outcomes counted by broadcast_message. "blocked" and "not_found" chats
+# will never accept a message again and are pruned from subscribers.
+DELIVERY_OUTCOMES = ("sent", "blocked", "not_found", "throttled", "network", "failed")
+DEAD_OUTCOMES = ("blocked", "not_found")
+_NOT_FOUND_ERRORS = ("chat not found", "user not found", "peer_id_invalid", "user is deactivated")
+
+def classify_delivery(res: Dict[str, Any]) -> str:
+    """Map a sendMessage result to one of DELIVERY_OUTCOMES."""
+    if res.get("ok"):
+        return "sent"
+    code = res.get("error_code")
+    if code is None:
+        return "network"  # tg.call returns {"ok": False, "error": ...} when the request itself failed
+    if code == 403:
+        return "blocked"  # bot blocked by the user, or the user account was deleted
+    if code == 400 and any(e in (res.get("description") or "").lower() for e in _NOT_FOUND_ERRORS):
+        return "not_found"
+    if code == 429:
+        return "throttled"
+    return "failed"
+
+def _paced_call(limiter: RateLimiter, token: str, method: str, payload: Optional[Dict[str, Any]] = None,
+                timeout: Optional[float] = None, files: Optional[Dict[str, Tuple[str, bytes]]] = None) -> Dict[str, Any]:
+    """tg.call paced by `limiter`; a 429 pauses the limiter (every sender sharing it) and is retried."""
+    for _ in range(BROADCAST_MAX_RETRIES + 1):
+        limiter.wait()
+        res = tg.call(token, method, payload, timeout=timeout, files=files)
+        wait = _retry_after(res)
+        if wait is None:
+            return res
+        limiter.pause(wait)
+    return res
+
+def _broadcast_one(token: str, chat_id: int, method: str, payload: Dict[str, Any], limiter: RateLimiter,
+                   files: Optional[Dict[str, Tuple[str, bytes]]] = None) -> Tuple[str, Dict[str, Any]]:
+    """Send one broadcast call to `chat_id`, retrying 429s; returns (outcome, last result)."""
+    timeout = TELEGRAM_UPLOAD_TIMEOUT if files else None
+    res = _paced_call(limiter, token, method, dict(payload, chat_id=chat_id), timeout=timeout, files=files)
+    return classify_delivery(res), res
+
+def broadcast_text(token: str, chat_ids: Iterable[int], text: str, limiter: Optional[RateLimiter] = None) -> Dict[str, Any]:
+    return broadcast_message(token, chat_ids, "sendMessage", {"text": text, "parse_mode": "HTML"}, limiter)
+
+def broadcast_message(token: str, chat_ids: Iterable[int], method: str, payload: Dict[str, Any],
+                      limiter: Optional[RateLimiter] = None, stop: Optional[threading.Event] = None) -> Dict[str, Any]:
+    """Make the same Bot API call for every chat in `chat_ids` through a bounded worker pool.
+
+    Subscriber ids are unique keys, so each chat receives exactly one message per
+    broadcast and Telegram's per-chat limit cannot be hit; the job is paced by a
+    RateLimiter below the per-bot limit that bot_limits enforces. Returns a
+    count per DELIVERY_OUTCOMES entry ("throttled" = still rate limited after
+    all retries) plus `dead`, the chat ids that can be pruned. Once `stop` is
+    set, chats not yet sent to are skipped and left out of the counts.
+    """
+    stats: Dict[str, Any] = {o: 0 for o in DELIVERY_OUTCOMES}
+    dead: List[int] = []
+    lock = threading.Lock()
+    limiter = limiter or RateLimiter(BROADCAST_RATE)
+    # keep a bounded number of pending sends so large audiences are not queued up front
+    window = threading.BoundedSemaphore(BROADCAST_WORKERS * 2)
+    total = 0
+    started = time.monotonic()
 
+    def run(cid: int):
+        try:
+            if stop is not None and stop.is_set():
+                return
+            outcome, _ = _broadcast_one(token, cid, method, payload, limiter)
+        except Exception:
+            logger.exception("broadcast send to %s failed", cid)
+            outcome = "failed"
+        finally:
+            window.release()
+        BROADCAST_MESSAGES.labels(outcome).inc()
+        with lock:
+            stats[outcome] += 1
+            if outcome in DEAD_OUTCOMES:
+                dead.append(cid)
+
+    with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS, thread_name_prefix="broadcast") as pool:
+        for cid in chat_ids:
+            if stop is not None and stop.is_set():
+                break
+            total += 1
+            window.acquire()
+            pool.submit(run, int(cid))
+    stats["total"] = total
+    stats["elapsed"] = round(time.monotonic() - started, 2)
+    logger.info("Broadcast finished: %s", dict(stats))
+    stats["dead"] = dead
+    return stats
+
+# ---------------- Firebase init (lazy) ----------------
+# Nothing touches Firebase at import: the app and the refs below are set up by
+# the first storage helper that asks for them (see firebase_utils).
 FIREBASE_OK = False
-BOTS_REF = SUBS_REF = TEMPLATES_REF = ADMINS_REF = INFO_REF = None
-
-if FIREBASE_PY_AVAILABLE:
-    creds_dict = load_firebase_creds()
-    if creds_dict:
-        try:
-            db_url = FIREBASE_DB_URL_ENV or f"https://{creds_dict.get('project_id')}-default-rtdb.firebaseio.com/"
-            cred = credentials.Certificate(creds_dict)
-            firebase_admin.initialize_app(cred, {"databaseURL": db_url})
-            BOTS_REF = db.reference("bots")
-            SUBS_REF = db.reference("subscribers")
-            TEMPLATES_REF = db.reference("templates")
-            ADMINS_REF = db.reference("admins")
-            INFO_REF = db.reference("info")
-            FIREBASE_OK = True
-            logger.info("✅ Firebase инициализация сәтті: %s", db_url)
-        except Exception:
-            logger.exception("Firebase инициализация сәтсіз.")
-    else:
-        logger.info("Firebase credentials табылмады — локал fallback пайдаланылады.")
-else:
-    logger.info("firebase_admin пакеті орнатылмаған — локал fallback пайдаланылады.")
-
-# ---------------- Local fallback storage ----------------
-LOCAL_DB_DIR = "local_db"
+ROOT_REF = BOTS_REF = SUBS_REF = TEMPLATES_REF = ADMINS_REF = INFO_REF = JOBS_REF = None
+OWNER_INDEX_REF = TEMPLATE_INDEX_REF = COUNTS_REF = STATS_REF = None
+MEDIA_GROUPS_REF = MEDIA_CACHE_REF = AUTOPOST_INDEX_REF = None
+_firebase_checked = False
+
+def firebase_ready() -> bool:
+    """True when Firebase is usable; initializes it and the refs on first call."""
+    global _firebase_checked, FIREBASE_OK, ROOT_REF, BOTS_REF, SUBS_REF, TEMPLATES_REF, ADMINS_REF
+    global INFO_REF, JOBS_REF, OWNER_INDEX_REF, TEMPLATE_INDEX_REF, COUNTS_REF, STATS_REF
+    global MEDIA_GROUPS_REF, MEDIA_CACHE_REF, AUTOPOST_INDEX_REF
+    if _firebase_checked:
+        return FIREBASE_OK
+    if get_firebase_app() is not None:
+        from firebase_admin import db
+        ROOT_REF = db.reference("/")
+        BOTS_REF = db.reference("bots")
+        OWNER_INDEX_REF = db.reference("bots_by_owner")
+        SUBS_REF = db.reference("subscribers")
+        COUNTS_REF = db.reference("subscriber_counts")
+        STATS_REF = db.reference("stats")
+        TEMPLATES_REF = db.reference("templates")
+        TEMPLATE_INDEX_REF = db.reference("templates_by_owner")
+        ADMINS_REF = db.reference("admins")
+        INFO_REF = db.reference("info")
+        JOBS_REF = db.reference("broadcast_jobs")
+        MEDIA_GROUPS_REF = db.reference("media_groups")
+        MEDIA_CACHE_REF = db.reference("media_cache")
+        AUTOPOST_INDEX_REF = db.reference("autopost_index")
+        FIREBASE_OK = True
+    _firebase_checked = True
+    return FIREBASE_OK
+
+# ---------------- Local fallback storage (SQLite) ----------------
+# One WAL-mode SQLite file shared by all gunicorn workers. Every helper writes
+# only the rows it touches, inside a transaction, so concurrent workers no longer
+# overwrite each other and a crash cannot leave a half-written file behind.
+LOCAL_DB_DIR = os.getenv("LOCAL_DB_DIR", "local_db")
+LOCAL_DB_PATH = os.path.join(LOCAL_DB_DIR, "manybot.sqlite3")
 os.makedirs(LOCAL_DB_DIR, exist_ok=True)
 
+LOCAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS bots (
+    key TEXT PRIMARY KEY, owner INTEGER NOT NULL, bot_id INTEGER NOT NULL, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS bots_owner ON bots (owner, key);
+CREATE INDEX IF NOT EXISTS bots_route ON bots (owner, bot_id);
+CREATE TABLE IF NOT EXISTS subscribers (
+    bot_key TEXT NOT NULL, user_id INTEGER NOT NULL, PRIMARY KEY (bot_key, user_id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS subscriber_counts (bot_key TEXT PRIMARY KEY, n INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS templates (
+    key TEXT PRIMARY KEY, owner INTEGER NOT NULL, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS templates_owner ON templates (owner, key);
+CREATE TABLE IF NOT EXISTS admins (user_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER NOT NULL, pref TEXT NOT NULL, value TEXT, PRIMARY KEY (user_id, pref)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+    key TEXT PRIMARY KEY, created_at INTEGER NOT NULL, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS seen_updates (
+    bot TEXT NOT NULL, update_id INTEGER NOT NULL, seen_at INTEGER NOT NULL,
+    PRIMARY KEY (bot, update_id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS seen_updates_age ON seen_updates (seen_at);
+CREATE TABLE IF NOT EXISTS rate_buckets (key TEXT PRIMARY KEY, tat REAL NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS media_group_parts (
+    group_id TEXT NOT NULL, message_id INTEGER NOT NULL, data TEXT NOT NULL, received_at INTEGER NOT NULL,
+    PRIMARY KEY (group_id, message_id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS media_cache (
+    bot_id INTEGER NOT NULL, file_unique_id TEXT NOT NULL, file_id TEXT NOT NULL,
+    PRIMARY KEY (bot_id, file_unique_id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS autopost_index (key TEXT PRIMARY KEY, due INTEGER NOT NULL);
+"""
+
+_local_conn = threading.local()
+
+def local_db() -> sqlite3.Connection:
+    """Per-thread connection (re-opened after fork) in autocommit mode."""
+    conn = getattr(_local_conn, "conn", None)
+    if conn is None or _local_conn.pid != os.getpid():
+        fresh = not os.path.exists(LOCAL_DB_PATH)
+        conn = sqlite3.connect(LOCAL_DB_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # NORMAL is corruption-safe in WAL mode; only an OS crash can drop the last commits
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        conn.executescript(LOCAL_SCHEMA)
+        _local_conn.conn, _local_conn.pid = conn, os.getpid()
+        if fresh:
+            n = import_local_json()
+            if n:
+                logger.info("Imported %s records from local_db/*.json into %s", n, LOCAL_DB_PATH)
+    return conn
+
+@contextmanager
+def local_tx():
+    """Write transaction; BEGIN IMMEDIATE serialises writers across processes."""
+    conn = local_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
 def read_local(name: str) -> dict:
+    """Read a legacy local_db/<name>.json file (used only by the importer)."""
     p = os.path.join(LOCAL_DB_DIR, name + ".json")
     if not os.path.exists(p):
         return {}
@@ -160,15 +714,102 @@ def read_local(name: str) -> dict:
     except Exception:
         return {}
 
-def write_local(name: str, data: dict):
-    p = os.path.join(LOCAL_DB_DIR, name + ".json")
-    with open(p, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def import_local_json() -> int:
+    """Copy legacy local_db/*.json data into SQLite. Existing rows are kept; returns rows inserted."""
+    n = 0
+    with local_tx() as c:
+        for k, v in read_local("bots").items():
+            n += c.execute("INSERT OR IGNORE INTO bots (key, owner, bot_id, data) VALUES (?, ?, ?, ?)",
+                           (k, int(v.get("owner", 0)), int(v.get("bot_id", 0)), json.dumps(v, ensure_ascii=False))).rowcount
+        for k, users in read_local("subscribers").items():
+            for uid in (users or {}):
+                n += c.execute("INSERT OR IGNORE INTO subscribers (bot_key, user_id) VALUES (?, ?)", (k, int(uid))).rowcount
+        for k, v in read_local("templates").items():
+            n += c.execute("INSERT OR IGNORE INTO templates (key, owner, data) VALUES (?, ?, ?)",
+                           (k, int(v.get("owner", 0)), json.dumps(v, ensure_ascii=False))).rowcount
+        for uid, flag in read_local("admins").items():
+            if flag:
+                n += c.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (int(uid),)).rowcount
+        for uid, prefs in read_local("users").items():
+            for pref, value in (prefs or {}).items():
+                n += c.execute("INSERT OR IGNORE INTO users (user_id, pref, value) VALUES (?, ?, ?)",
+                               (int(uid), pref, json.dumps(value))).rowcount
+        for k, v in read_local("broadcast_jobs").items():
+            n += c.execute("INSERT OR IGNORE INTO broadcast_jobs (key, created_at, data) VALUES (?, ?, ?)",
+                           (k, int(v.get("created_at", 0)), json.dumps(v, ensure_ascii=False))).rowcount
+        _recount_local(c)
+    return n
 
 def gen_key() -> str:
     return uuid.uuid4().hex
 
+# ---------------- Read cache ----------------
+# Bot records, admin flags and user prefs are read several times per command.
+# Writes in this process invalidate entries at once; other workers see a change
+# after at most CACHE_TTL seconds.
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+CACHE_MAX = int(os.getenv("CACHE_MAX", "10000"))
+_MISSING = object()
+
+class TTLCache:
+    """Thread-safe bounded cache with per-entry TTL and LRU eviction."""
+
+    def __init__(self, name: str, maxsize: int = CACHE_MAX, ttl: float = CACHE_TTL):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Any:
+        """Return the cached value or `_MISSING`."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return _MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: Any, value: Any):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Any):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"name": self.name, "size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+bot_cache = TTLCache("bots")
+admin_cache = TTLCache("admins")
+pref_cache = TTLCache("prefs")
+owner_keys_cache = TTLCache("owner_keys")
+_ADMIN_LIST = "*"
+
+def cache_stats() -> List[Dict[str, Any]]:
+    return [c.stats() for c in (bot_cache, admin_cache, pref_cache, owner_keys_cache, token_cache)]
+
 # ---------------- Storage helpers (Firebase or local) ----------------
+class _TxAbort(Exception):
+    """Raised inside a Firebase transaction to leave the node untouched."""
+
+# "<owner>_<bot_id>" -> DB key, for webhooks still registered on the legacy /u/ path
+_bot_route_index: Dict[str, str] = {}
+_bot_route_index_built = 0.0
+BOT_ROUTE_INDEX_REFRESH = int(os.getenv("BOT_ROUTE_INDEX_REFRESH", "60"))
+_bot_route_index_lock = threading.Lock()
+
+@storage_op
 def save_bot_record(owner: int, bot_id: int, username: str, token_plain: str) -> str:
     rec = {
         "owner": int(owner),
@@ -181,176 +822,1316 @@ def save_bot_record(owner: int, bot_id: int, username: str, token_plain: str) ->
         "bot_lang": "kk",  # default kazakh
         "created_at": int(time.time())
     }
-    if FIREBASE_OK and BOTS_REF:
+    if firebase_ready() and BOTS_REF:
         try:
             ref = BOTS_REF.push(rec)
+            bot_cache.invalidate(ref.key)
+            owner_keys_cache.invalidate(int(owner))
+            _bot_route_index[f"{int(owner)}_{int(bot_id)}"] = ref.key
+            try:
+                OWNER_INDEX_REF.child(str(int(owner))).child(ref.key).set(True)
+            except Exception:
+                # `flask --app main build-owner-index` repairs a missing entry
+                logger.exception("Firebase owner index update failed for %s", ref.key)
             return ref.key
         except Exception:
             logger.exception("Firebase push failed, falling back to local.")
-    d = read_local("bots")
+            note_storage_fallback()
     k = gen_key()
-    d[k] = rec
-    write_local("bots", d)
+    with local_tx() as c:
+        c.execute("INSERT INTO bots (key, owner, bot_id, data) VALUES (?, ?, ?, ?)",
+                  (k, int(owner), int(bot_id), json.dumps(rec, ensure_ascii=False)))
+    bot_cache.invalidate(k)
+    owner_keys_cache.invalidate(int(owner))
+    _bot_route_index[f"{int(owner)}_{int(bot_id)}"] = k
     return k
 
+@storage_op
 def update_bot_field(key: str, field: str, value: Any):
     """Update a single field for bot record in Firebase or local fallback."""
-    if FIREBASE_OK and BOTS_REF:
+    bot_cache.invalidate(key)
+    token_cache.invalidate(key)
+    if firebase_ready() and BOTS_REF:
         try:
             BOTS_REF.child(key).update({field: value})
             return True
         except Exception:
             logger.exception("Firebase update_bot_field failed, falling back to local.")
-    d = read_local("bots")
-    if key in d:
-        d[key][field] = value
-        write_local("bots", d)
-        return True
-    return False
-
+            note_storage_fallback()
+    with local_tx() as c:
+        row = c.execute("SELECT data FROM bots WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return False
+        rec = json.loads(row[0])
+        rec[field] = value
+        c.execute("UPDATE bots SET data = ? WHERE key = ?", (json.dumps(rec, ensure_ascii=False), key))
+    return True
+
+@storage_op
 def get_all_bots() -> dict:
-    if FIREBASE_OK and BOTS_REF:
+    if firebase_ready() and BOTS_REF:
         try:
             return BOTS_REF.get() or {}
         except Exception:
             logger.exception("Firebase get_all_bots failed")
-    return read_local("bots")
+            note_storage_fallback()
+    return {k: json.loads(d) for k, d in local_db().execute("SELECT key, data FROM bots")}
+
+def iter_bot_pages(batch: int = 200) -> Iterator[List[Tuple[str, dict]]]:
+    """Yield the bots table as key-ordered pages of (key, record), `batch` at a time."""
+    cursor = None
+    while True:
+        if firebase_ready() and BOTS_REF:
+            q = BOTS_REF.order_by_key()
+            q = q.start_at(cursor).limit_to_first(batch + 1) if cursor else q.limit_to_first(batch)
+            page = [(k, v) for k, v in sorted((q.get() or {}).items()) if k != cursor]
+        else:
+            rows = local_db().execute("SELECT key, data FROM bots WHERE key > ? ORDER BY key LIMIT ?",
+                                      (cursor or "", batch)).fetchall()
+            page = [(k, json.loads(d)) for k, d in rows]
+        if not page:
+            return
+        yield page
+        cursor = page[-1][0]
 
 def get_bot_by_key(key: str) -> Optional[dict]:
-    if FIREBASE_OK and BOTS_REF:
+    """Cached; callers must not mutate the returned record."""
+    rec = bot_cache.get(key)
+    if rec is _MISSING:
+        rec = _load_bot_by_key(key)
+        bot_cache.set(key, rec)
+    return rec
+
+@storage_op
+def _load_bot_by_key(key: str) -> Optional[dict]:
+    if firebase_ready() and BOTS_REF:
         try:
             return BOTS_REF.child(key).get()
         except Exception:
             logger.exception("Firebase get bot failed")
-    return read_local("bots").get(key)
+            note_storage_fallback()
+    row = local_db().execute("SELECT data FROM bots WHERE key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+@storage_op
+def get_bots_by_owner(owner: int) -> dict:
+    """Return {key: record} for one owner via the bots_by_owner index."""
+    if firebase_ready() and OWNER_INDEX_REF:
+        try:
+            keys = OWNER_INDEX_REF.child(str(int(owner))).get() or {}
+            out = {}
+            for k in (keys.keys() if isinstance(keys, dict) else []):
+                rec = BOTS_REF.child(k).get()
+                if rec:
+                    out[k] = rec
+            return out
+        except Exception:
+            logger.exception("Firebase get_bots_by_owner failed")
+            note_storage_fallback()
+    rows = local_db().execute("SELECT key, data FROM bots WHERE owner = ? ORDER BY key", (int(owner),))
+    return {k: json.loads(d) for k, d in rows}
+
+@storage_op
+def get_bot_keys_by_owner(owner: int) -> List[str]:
+    """An owner's DB keys from the index alone, without reading the bot records."""
+    if firebase_ready() and OWNER_INDEX_REF:
+        try:
+            return list(OWNER_INDEX_REF.child(str(int(owner))).get(shallow=True) or {})
+        except Exception:
+            logger.exception("Firebase get_bot_keys_by_owner failed")
+            note_storage_fallback()
+    return [r[0] for r in local_db().execute("SELECT key FROM bots WHERE owner = ? ORDER BY key", (int(owner),))]
+
+def owner_bot_keys(owner: int) -> frozenset:
+    """Cached set of an owner's DB keys (cheap membership test for the main webhook)."""
+    keys = owner_keys_cache.get(int(owner))
+    if keys is _MISSING:
+        keys = frozenset(get_bot_keys_by_owner(owner))
+        owner_keys_cache.set(int(owner), keys)
+    return keys
+
+def owns_bot_key(owner: int, key: str) -> bool:
+    """True if `key` is one of the owner's bots. A miss re-reads the key set once:
+    the cache is per process, so a bot added through another worker may not be in it yet."""
+    if key in owner_bot_keys(owner):
+        return True
+    owner_keys_cache.invalidate(int(owner))
+    return key in owner_bot_keys(owner)
 
+def build_owner_index() -> int:
+    """Rebuild bots_by_owner from the bots tree. Returns the number of indexed bots.
+
+    Locally the owner index is the SQLite `bots_owner` index, so there is nothing to build.
+    """
+    if not (firebase_ready() and OWNER_INDEX_REF):
+        return local_db().execute("SELECT COUNT(*) FROM bots").fetchone()[0]
+    all_bots = get_all_bots() or {}
+    idx: Dict[str, Dict[str, bool]] = {}
+    for k, v in (all_bots.items() if isinstance(all_bots, dict) else []):
+        if isinstance(v, dict) and v.get("owner") is not None:
+            idx.setdefault(str(int(v["owner"])), {})[k] = True
+    OWNER_INDEX_REF.set(idx)
+    return sum(len(v) for v in idx.values())
+
+def resolve_legacy_route(owner_bot: str) -> Optional[str]:
+    """Map a legacy "<owner>_<bot_id>" webhook path to a DB key.
+
+    Hits are dict lookups; a miss rebuilds the index from storage at most once
+    per BOT_ROUTE_INDEX_REFRESH seconds, so unknown paths cannot force a full
+    download on every update.
+    """
+    global _bot_route_index_built
+    key = _bot_route_index.get(owner_bot)
+    if key:
+        return key
+    with _bot_route_index_lock:
+        if owner_bot in _bot_route_index:
+            return _bot_route_index[owner_bot]
+        if time.time() - _bot_route_index_built < BOT_ROUTE_INDEX_REFRESH:
+            return None
+        all_bots = get_all_bots() or {}
+        for k, v in (all_bots.items() if isinstance(all_bots, dict) else []):
+            _bot_route_index[f"{v.get('owner')}_{v.get('bot_id')}"] = k
+        _bot_route_index_built = time.time()
+        return _bot_route_index.get(owner_bot)
+
+def webhook_secret(key: str) -> str:
+    """Per-bot secret_token for setWebhook, derived so it never has to be stored."""
+    return hmac.new(WEBHOOK_SECRET.encode(), key.encode(), hashlib.sha256).hexdigest()
+
+@storage_op
 def delete_bot_by_key(key: str):
-    if FIREBASE_OK and BOTS_REF:
+    rec = get_bot_by_key(key) or {}
+    bot_cache.invalidate(key)
+    token_cache.invalidate(key)
+    owner = rec.get("owner")
+    if owner is not None:
+        owner_keys_cache.invalidate(int(owner))
+    if firebase_ready() and ROOT_REF:
         try:
-            BOTS_REF.child(key).delete()
-            if SUBS_REF:
-                try:
-                    SUBS_REF.child(key).delete()
-                except Exception:
-                    pass
+            removed = int(COUNTS_REF.child(key).get() or 0)
+            paths = {f"bots/{key}": None, f"subscribers/{key}": None, f"subscriber_counts/{key}": None,
+                     f"autopost_index/{key}": None}
+            if owner is not None:
+                paths[f"bots_by_owner/{int(owner)}/{key}"] = None
+            ROOT_REF.update(paths)
+            if removed:
+                STATS_REF.child("subscribers_total").transaction(lambda cur: max(0, (cur or 0) - removed))
             return
         except Exception:
             logger.exception("Firebase delete bot error, falling back to local.")
-    d = read_local("bots")
-    if key in d:
-        del d[key]
-        write_local("bots", d)
-    subs = read_local("subscribers")
-    if key in subs:
-        del subs[key]
-        write_local("subscribers", subs)
-
+            note_storage_fallback()
+    with local_tx() as c:
+        c.execute("DELETE FROM bots WHERE key = ?", (key,))
+        c.execute("DELETE FROM subscribers WHERE bot_key = ?", (key,))
+        c.execute("DELETE FROM autopost_index WHERE key = ?", (key,))
+        row = c.execute("SELECT n FROM subscriber_counts WHERE bot_key = ?", (key,)).fetchone()
+        if row:
+            c.execute("DELETE FROM subscriber_counts WHERE bot_key = ?", (key,))
+            _bump_local_total(c, -row[0])
+
+# Subscriber counters: subscriber_counts/<bot_key> and stats/subscribers_total are
+# adjusted only when a subscriber node is actually created or removed, so reads are O(1).
+def _bump_firebase_counters(bot_key: str, delta: int):
+    COUNTS_REF.child(bot_key).transaction(lambda cur: max(0, (cur or 0) + delta))
+    STATS_REF.child("subscribers_total").transaction(lambda cur: max(0, (cur or 0) + delta))
+
+def _bump_local_counters(c: sqlite3.Connection, bot_key: str, delta: int):
+    c.execute("INSERT INTO subscriber_counts (bot_key, n) VALUES (?, max(0, ?)) "
+              "ON CONFLICT (bot_key) DO UPDATE SET n = max(0, n + ?)", (bot_key, delta, delta))
+    _bump_local_total(c, delta)
+
+def _bump_local_total(c: sqlite3.Connection, delta: int):
+    c.execute("INSERT INTO stats (name, value) VALUES ('subscribers_total', max(0, ?)) "
+              "ON CONFLICT (name) DO UPDATE SET value = max(0, value + ?)", (delta, delta))
+
+@storage_op
 def add_subscriber(bot_key: str, user_id: int):
-    if FIREBASE_OK and SUBS_REF:
+    if firebase_ready() and SUBS_REF:
         try:
-            SUBS_REF.child(bot_key).child(str(user_id)).set(True)
+            def tx(cur):
+                if cur is not None:
+                    raise _TxAbort()
+                return True
+            try:
+                SUBS_REF.child(bot_key).child(str(user_id)).transaction(tx)
+            except _TxAbort:
+                return
+            _bump_firebase_counters(bot_key, 1)
             return
         except Exception:
             logger.exception("Firebase add_subscriber failed, fallback to local.")
-    subs = read_local("subscribers")
-    if bot_key not in subs:
-        subs[bot_key] = {}
-    subs[bot_key][str(user_id)] = True
-    write_local("subscribers", subs)
+            note_storage_fallback()
+    with local_tx() as c:
+        if c.execute("INSERT OR IGNORE INTO subscribers (bot_key, user_id) VALUES (?, ?)",
+                     (bot_key, int(user_id))).rowcount:
+            _bump_local_counters(c, bot_key, 1)
+
+@storage_op
+def add_subscribers_bulk(entries: List[Tuple[str, int]]):
+    """Store many (bot_key, user_id) pairs in one write.
+
+    Firebase gets a single multi-path update with server-side counter increments
+    and no per-pair reads. Repeat /starts are already dropped by
+    SubscriberBuffer's seen set; a pair stored before (by another worker, or
+    before a restart) is counted again, which `recount-subscribers` corrects.
+    """
+    if not entries:
+        return
+    if firebase_ready() and ROOT_REF:
+        try:
+            entries = list(dict.fromkeys((bot_key, int(user_id)) for bot_key, user_id in entries))
+            paths: Dict[str, Any] = {}
+            per_bot: Dict[str, int] = {}
+            for bot_key, user_id in entries:
+                paths[f"subscribers/{bot_key}/{int(user_id)}"] = True
+                per_bot[bot_key] = per_bot.get(bot_key, 0) + 1
+            for bot_key, n in per_bot.items():
+                paths[f"subscriber_counts/{bot_key}"] = {".sv": {"increment": n}}
+            paths["stats/subscribers_total"] = {".sv": {"increment": len(entries)}}
+            ROOT_REF.update(paths)
+            return
+        except Exception:
+            logger.exception("Firebase add_subscribers_bulk failed, fallback to local.")
+            note_storage_fallback()
+    with local_tx() as c:
+        for bot_key, user_id in entries:
+            if c.execute("INSERT OR IGNORE INTO subscribers (bot_key, user_id) VALUES (?, ?)",
+                         (bot_key, int(user_id))).rowcount:
+                _bump_local_counters(c, bot_key, 1)
+
+@storage_op
+def remove_subscriber(bot_key: str, user_id: int):
+    if firebase_ready() and SUBS_REF:
+        try:
+            def tx(cur):
+                if cur is None:
+                    raise _TxAbort()
+                return None
+            try:
+                SUBS_REF.child(bot_key).child(str(user_id)).transaction(tx)
+            except _TxAbort:
+                return
+            _bump_firebase_counters(bot_key, -1)
+            return
+        except Exception:
+            logger.exception("Firebase remove_subscriber failed, fallback to local.")
+            note_storage_fallback()
+    with local_tx() as c:
+        if c.execute("DELETE FROM subscribers WHERE bot_key = ? AND user_id = ?",
+                     (bot_key, int(user_id))).rowcount:
+            _bump_local_counters(c, bot_key, -1)
+    subscriber_buffer.forget(bot_key, [user_id])
+
+@storage_op
+def remove_subscribers(bot_key: str, user_ids: List[int]) -> int:
+    """Remove many subscribers of one bot in a single write. Returns how many were removed.
+
+    Used to prune chats a broadcast found dead; the ids were just read from the
+    subscribers node, so Firebase counters are decremented by the batch size.
+    """
+    user_ids = sorted(set(int(u) for u in user_ids))
+    if not user_ids:
+        return 0
+    subscriber_buffer.forget(bot_key, user_ids)
+    if firebase_ready() and ROOT_REF:
+        try:
+            paths: Dict[str, Any] = {f"subscribers/{bot_key}/{u}": None for u in user_ids}
+            paths[f"subscriber_counts/{bot_key}"] = {".sv": {"increment": -len(user_ids)}}
+            paths["stats/subscribers_total"] = {".sv": {"increment": -len(user_ids)}}
+            ROOT_REF.update(paths)
+            return len(user_ids)
+        except Exception:
+            logger.exception("Firebase remove_subscribers failed, fallback to local.")
+            note_storage_fallback()
+    removed = 0
+    with local_tx() as c:
+        for u in user_ids:
+            removed += c.execute("DELETE FROM subscribers WHERE bot_key = ? AND user_id = ?", (bot_key, u)).rowcount
+        if removed:
+            _bump_local_counters(c, bot_key, -removed)
+    return removed
+
+SUBSCRIBERS_PAGE = int(os.getenv("SUBSCRIBERS_PAGE", "1000"))
+
+def firebase_key_order(key: str) -> tuple:
+    """Sort key matching Firebase's order_by_key: 32-bit integer keys numerically, then strings."""
+    try:
+        n = int(key)
+    except ValueError:
+        n = None
+    if n is not None and str(n) == key and -2 ** 31 <= n < 2 ** 31:
+        return (0, n, "")
+    return (1, 0, key)
+
+@storage_op
+def _subscriber_page(bot_key: str, after: Optional[int], limit: int) -> List[int]:
+    if firebase_ready() and SUBS_REF:
+        try:
+            q = SUBS_REF.child(bot_key).order_by_key()
+            q = q.start_at(str(after)).limit_to_first(limit + 1) if after is not None else q.limit_to_first(limit)
+            # the SDK re-sorts $key results as plain strings, so restore the server's order:
+            # the page cursor (and the job checkpoint) must be the last id in that order
+            keys = sorted((q.get() or {}), key=firebase_key_order)
+            return [int(k) for k in keys if after is None or k != str(after)]
+        except Exception:
+            logger.exception("Firebase subscriber page failed, falling back to local.")
+            note_storage_fallback()
+    rows = local_db().execute(
+        "SELECT user_id FROM subscribers WHERE bot_key = ? AND user_id > ? ORDER BY user_id LIMIT ?",
+        (bot_key, after if after is not None else -(2 ** 63), limit))
+    return [r[0] for r in rows]
+
+def iter_subscribers(bot_key: str, after: Optional[int] = None, page: int = SUBSCRIBERS_PAGE) -> Iterator[int]:
+    """Stream a bot's subscriber ids in storage key order, one page in memory at a time.
+
+    `after` resumes behind a previously yielded id (the broadcast checkpoint).
+    """
+    while True:
+        ids = _subscriber_page(bot_key, after, page)
+        if not ids:
+            return
+        yield from ids
+        after = ids[-1]
 
-def get_subscribers(bot_key: str) -> List[int]:
-    if FIREBASE_OK and SUBS_REF:
+@storage_op
+def count_subscribers(bot_key: str) -> int:
+    if firebase_ready() and COUNTS_REF:
         try:
-            d = SUBS_REF.child(bot_key).get() or {}
-            return [int(k) for k in d.keys()] if isinstance(d, dict) else []
+            return int(COUNTS_REF.child(bot_key).get() or 0)
         except Exception:
-            logger.exception("Firebase get_subscribers failed")
-    subs = read_local("subscribers")
-    d = subs.get(bot_key, {}) or {}
-    return [int(k) for k in d.keys()]
+            logger.exception("Firebase count_subscribers failed")
+            note_storage_fallback()
+    row = local_db().execute("SELECT n FROM subscriber_counts WHERE bot_key = ?", (bot_key,)).fetchone()
+    return row[0] if row else 0
 
+@storage_op
 def count_total_subscribers() -> int:
-    if FIREBASE_OK and SUBS_REF:
+    if firebase_ready() and STATS_REF:
         try:
-            allsubs = SUBS_REF.get() or {}
-            total = 0
-            if isinstance(allsubs, dict):
-                for k, v in allsubs.items():
-                    if isinstance(v, dict):
-                        total += len(v)
-            return total
+            return int(STATS_REF.child("subscribers_total").get() or 0)
         except Exception:
             logger.exception("Firebase count_total_subscribers failed")
-    subs = read_local("subscribers")
-    total = 0
-    for v in subs.values():
-        total += len(v)
-    return total
-
+            note_storage_fallback()
+    row = local_db().execute("SELECT value FROM stats WHERE name = 'subscribers_total'").fetchone()
+    return row[0] if row else 0
+
+def recount_subscribers() -> Dict[str, int]:
+    """Recompute every counter from the subscribers tree (repair tool)."""
+    if firebase_ready() and SUBS_REF:
+        allsubs = SUBS_REF.get() or {}
+        counts = {k: len(v) for k, v in allsubs.items() if isinstance(v, dict)} if isinstance(allsubs, dict) else {}
+        COUNTS_REF.set(counts or {})
+        STATS_REF.child("subscribers_total").set(sum(counts.values()))
+        return counts
+    with local_tx() as c:
+        return _recount_local(c)
+
+def _recount_local(c: sqlite3.Connection) -> Dict[str, int]:
+    c.execute("DELETE FROM subscriber_counts")
+    c.execute("INSERT INTO subscriber_counts (bot_key, n) SELECT bot_key, COUNT(*) FROM subscribers GROUP BY bot_key")
+    c.execute("INSERT OR REPLACE INTO stats (name, value) "
+              "VALUES ('subscribers_total', (SELECT COUNT(*) FROM subscribers))")
+    return dict(c.execute("SELECT bot_key, n FROM subscriber_counts").fetchall())
+
+TEMPLATES_PAGE_SIZE = int(os.getenv("TEMPLATES_PAGE_SIZE", "5"))
+
+@storage_op
 def save_template(owner: int, title: str, content: str) -> str:
     rec = {"owner": int(owner), "title": title, "content": content, "created_at": int(time.time())}
-    if FIREBASE_OK and TEMPLATES_REF:
+    if firebase_ready() and TEMPLATES_REF:
         try:
             ref = TEMPLATES_REF.push(rec)
+            try:
+                TEMPLATE_INDEX_REF.child(str(int(owner))).child(ref.key).set(True)
+            except Exception:
+                # `flask --app main build-template-index` repairs a missing entry
+                logger.exception("Firebase template index update failed for %s", ref.key)
             return ref.key
         except Exception:
             logger.exception("Firebase push template failed")
-    d = read_local("templates")
+            note_storage_fallback()
     k = gen_key()
-    d[k] = rec
-    write_local("templates", d)
+    with local_tx() as c:
+        c.execute("INSERT INTO templates (key, owner, data) VALUES (?, ?, ?)",
+                  (k, int(owner), json.dumps(rec, ensure_ascii=False)))
     return k
 
-def get_templates(owner: int) -> dict:
-    if FIREBASE_OK and TEMPLATES_REF:
+@storage_op
+def get_template(key: str) -> Optional[dict]:
+    if firebase_ready() and TEMPLATES_REF:
         try:
-            alld = TEMPLATES_REF.get() or {}
-            return {k: v for k, v in (alld.items() if isinstance(alld, dict) else []) if int(v.get("owner", 0)) == int(owner)}
+            return TEMPLATES_REF.child(key).get()
         except Exception:
-            logger.exception("Firebase get_templates failed")
-    d = read_local("templates")
-    return {k: v for k, v in d.items() if int(v.get("owner", 0)) == int(owner)}
+            logger.exception("Firebase get_template failed")
+            note_storage_fallback()
+    row = local_db().execute("SELECT data FROM templates WHERE key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+@storage_op
+def _template_page_keys(owner: int, cursor: Optional[str], backwards: bool, limit: int) -> List[str]:
+    """Key-ordered slice of the owner's template index, one extra key to detect more pages.
+
+    Forward pages start after `cursor`; backward pages end before it.
+    """
+    if firebase_ready() and TEMPLATE_INDEX_REF:
+        try:
+            q = TEMPLATE_INDEX_REF.child(str(int(owner))).order_by_key()
+            extra = 2 if cursor else 1
+            if backwards:
+                q = q.end_at(cursor).limit_to_last(limit + extra) if cursor else q.limit_to_last(limit + extra)
+            else:
+                q = q.start_at(cursor).limit_to_first(limit + extra) if cursor else q.limit_to_first(limit + extra)
+            keys = sorted((q.get() or {}).keys())
+            return [k for k in keys if k != cursor]
+        except Exception:
+            logger.exception("Firebase template page query failed")
+            note_storage_fallback()
+    if backwards:
+        rows = local_db().execute("SELECT key FROM templates WHERE owner = ? AND key < ? ORDER BY key DESC LIMIT ?",
+                                  (int(owner), cursor or "\uffff", limit + 1))
+        return sorted(r[0] for r in rows)
+    rows = local_db().execute("SELECT key FROM templates WHERE owner = ? AND key > ? ORDER BY key LIMIT ?",
+                              (int(owner), cursor or "", limit + 1))
+    return [r[0] for r in rows]
+
+def get_templates_page(owner: int, cursor: Optional[str] = None, backwards: bool = False,
+                       limit: int = TEMPLATES_PAGE_SIZE) -> tuple:
+    """Return (templates, has_prev, has_next) for one page of an owner's templates.
+
+    Only the templates on the page are fetched; `templates` is an ordered list
+    of (key, record) pairs.
+    """
+    keys = _template_page_keys(owner, cursor, backwards, limit)
+    more = len(keys) > limit
+    if backwards:
+        keys = keys[-limit:]
+        has_prev, has_next = more, True
+    else:
+        keys = keys[:limit]
+        has_prev, has_next = cursor is not None, more
+    out = []
+    for k in keys:
+        rec = get_template(k)
+        if rec:
+            out.append((k, rec))
+    return out, has_prev, has_next
+
+def build_template_index() -> int:
+    """Rebuild templates_by_owner from the templates tree. Returns the number of indexed templates.
+
+    Locally the owner index is the SQLite `templates_owner` index, so there is nothing to build.
+    """
+    if not (firebase_ready() and TEMPLATE_INDEX_REF):
+        return local_db().execute("SELECT COUNT(*) FROM templates").fetchone()[0]
+    alld = TEMPLATES_REF.get() or {}
+    idx: Dict[str, Dict[str, bool]] = {}
+    for k, v in (alld.items() if isinstance(alld, dict) else []):
+        if isinstance(v, dict) and v.get("owner") is not None:
+            idx.setdefault(str(int(v["owner"])), {})[k] = True
+    TEMPLATE_INDEX_REF.set(idx)
+    return sum(len(v) for v in idx.values())
 
 def is_admin(user_id: int) -> bool:
-    if FIREBASE_OK and ADMINS_REF:
+    v = admin_cache.get(int(user_id))
+    if v is _MISSING:
+        v = _load_is_admin(user_id)
+        admin_cache.set(int(user_id), v)
+    return v
+
+@storage_op
+def _load_is_admin(user_id: int) -> bool:
+    if firebase_ready() and ADMINS_REF:
         try:
             v = ADMINS_REF.child(str(user_id)).get()
             return bool(v)
         except Exception:
             logger.exception("Firebase is_admin check failed")
-    d = read_local("admins")
-    return str(user_id) in d and d[str(user_id)]
+            note_storage_fallback()
+    return local_db().execute("SELECT 1 FROM admins WHERE user_id = ?", (int(user_id),)).fetchone() is not None
 
+@storage_op
 def add_admin(user_id: int):
-    if FIREBASE_OK and ADMINS_REF:
+    admin_cache.invalidate(int(user_id))
+    admin_cache.invalidate(_ADMIN_LIST)
+    if firebase_ready() and ADMINS_REF:
         try:
             ADMINS_REF.child(str(user_id)).set(True)
             return
         except Exception:
             logger.exception("Firebase add_admin failed")
-    d = read_local("admins"); d[str(user_id)] = True; write_local("admins", d)
+            note_storage_fallback()
+    with local_tx() as c:
+        c.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (int(user_id),))
 
+@storage_op
 def remove_admin(user_id: int):
-    if FIREBASE_OK and ADMINS_REF:
+    admin_cache.invalidate(int(user_id))
+    admin_cache.invalidate(_ADMIN_LIST)
+    if firebase_ready() and ADMINS_REF:
         try:
             ADMINS_REF.child(str(user_id)).delete()
             return
         except Exception:
             logger.exception("Firebase remove_admin failed")
-    d = read_local("admins")
-    if str(user_id) in d:
-        del d[str(user_id)]
-        write_local("admins", d)
+            note_storage_fallback()
+    with local_tx() as c:
+        c.execute("DELETE FROM admins WHERE user_id = ?", (int(user_id),))
 
 def list_admins() -> List[int]:
-    if FIREBASE_OK and ADMINS_REF:
+    v = admin_cache.get(_ADMIN_LIST)
+    if v is _MISSING:
+        v = _load_admins()
+        admin_cache.set(_ADMIN_LIST, v)
+    return list(v)
+
+@storage_op
+def _load_admins() -> List[int]:
+    if firebase_ready() and ADMINS_REF:
         try:
             d = ADMINS_REF.get() or {}
             return [int(k) for k in d.keys()] if isinstance(d, dict) else []
         except Exception:
             logger.exception("Firebase list_admins failed")
-    d = read_local("admins")
-    return [int(k) for k, v in d.items() if v]
+            note_storage_fallback()
+    return [r[0] for r in local_db().execute("SELECT user_id FROM admins")]
+
+# ----------------- broadcast job queue ----------------
+# Broadcasts are persisted in `broadcast_jobs` and executed by a worker, so the
+# webhook returns immediately. Only active jobs live in the node; finished jobs
+# are removed once the owner has been sent a report.
+JOB_LEASE_SECONDS = int(os.getenv("BROADCAST_JOB_LEASE", "120"))
+JOB_CHUNK = int(os.getenv("BROADCAST_JOB_CHUNK", "500"))          # subscribers per checkpoint
+JOB_POLL_SECONDS = float(os.getenv("BROADCAST_POLL_SECONDS", "5"))
+BROADCAST_PRUNE = os.getenv("BROADCAST_PRUNE", "1") == "1"        # drop blocked / not-found chats
+BROADCAST_WORKER_MODE = os.getenv("BROADCAST_WORKER_MODE", "inline")  # inline | external
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+_job_wakeup = threading.Event()
+
+def _job_claimable(job: Optional[dict], now: int) -> bool:
+    if not isinstance(job, dict):
+        return False
+    if job.get("status") == "pending":
+        return int(job.get("not_before", 0)) <= now
+    return job.get("status") == "running" and int(job.get("lease_until", 0)) < now
+
+def _job_owned(job: Optional[dict]) -> bool:
+    return isinstance(job, dict) and job.get("status") == "running" and job.get("worker") == WORKER_ID
+
+@storage_op
+def enqueue_broadcast(job_key: str, bot_key: str, owner_chat: int, text: str,
+                      media: Optional[List[dict]] = None, media_group: Optional[str] = None,
+                      not_before: int = 0) -> bool:
+    """Persist a broadcast job. Returns False if a job with this key already exists,
+    so a redelivered update does not queue the same broadcast twice.
+
+    With `media` (see message_media) or `media_group` the job sends that media
+    with `text` as its caption; the job is not picked up before `not_before`.
+    """
+    now = int(time.time())
+    job = {
+        "bot_key": bot_key,
+        "owner_chat": int(owner_chat),
+        "text": text,
+        "media": media,
+        "media_group": media_group,
+        "not_before": not_before,
+        "status": "pending",
+        "cursor": None,
+        "offset": 0,
+        **{o: 0 for o in DELIVERY_OUTCOMES},
+        "pruned": 0,
+        "created_at": now,
+        "updated_at": now,
+    }
+    if firebase_ready() and JOBS_REF:
+        try:
+            def tx(cur):
+                if cur is not None:
+                    raise _TxAbort()
+                return job
+            JOBS_REF.child(job_key).transaction(tx)
+        except _TxAbort:
+            return False  # already queued; not a storage error, so no local fallback
+        except Exception:
+            logger.exception("Firebase enqueue_broadcast failed, falling back to local.")
+            note_storage_fallback()
+        else:
+            _job_wakeup.set()
+            return True
+    with local_tx() as c:
+        created = c.execute("INSERT OR IGNORE INTO broadcast_jobs (key, created_at, data) VALUES (?, ?, ?)",
+                            (job_key, now, json.dumps(job, ensure_ascii=False))).rowcount > 0
+    _job_wakeup.set()
+    return created
+
+@storage_op
+def claim_broadcast_job() -> Optional[tuple]:
+    """Take the oldest pending job (or one whose worker's lease expired)."""
+    now = int(time.time())
+    lease = {"status": "running", "worker": WORKER_ID, "lease_until": now + JOB_LEASE_SECONDS}
+    if firebase_ready() and JOBS_REF:
+        try:
+            jobs = JOBS_REF.get() or {}
+            for k, job in sorted(jobs.items(), key=lambda kv: kv[1].get("created_at", 0)):
+                if not _job_claimable(job, now):
+                    continue
+                def tx(cur):
+                    if not _job_claimable(cur, now):
+                        raise _TxAbort()
+                    cur.update(lease)
+                    return cur
+                try:
+                    return k, JOBS_REF.child(k).transaction(tx)
+                except _TxAbort:
+                    continue
+            return None
+        except Exception:
+            logger.exception("Firebase claim_broadcast_job failed, falling back to local.")
+            note_storage_fallback()
+    with local_tx() as c:
+        for k, data in c.execute("SELECT key, data FROM broadcast_jobs ORDER BY created_at").fetchall():
+            job = json.loads(data)
+            if _job_claimable(job, now):
+                job.update(lease)
+                c.execute("UPDATE broadcast_jobs SET data = ? WHERE key = ?", (json.dumps(job, ensure_ascii=False), k))
+                return k, job
+    return None
+
+@storage_op
+def checkpoint_broadcast_job(job_key: str, fields: Dict[str, Any]) -> bool:
+    """Save progress and renew the job's lease. Returns False, writing nothing,
+    if the job is gone or another worker has claimed it since."""
+    fields = dict(fields, updated_at=int(time.time()), lease_until=int(time.time()) + JOB_LEASE_SECONDS)
+    if firebase_ready() and JOBS_REF:
+        try:
+            def tx(cur):
+                if not _job_owned(cur):
+                    raise _TxAbort()
+                cur.update(fields)
+                return cur
+            JOBS_REF.child(job_key).transaction(tx)
+            return True
+        except _TxAbort:
+            return False
+        except Exception:
+            logger.exception("Firebase checkpoint_broadcast_job failed, falling back to local.")
+            note_storage_fallback()
+    with local_tx() as c:
+        row = c.execute("SELECT data FROM broadcast_jobs WHERE key = ?", (job_key,)).fetchone()
+        job = json.loads(row[0]) if row else None
+        if not _job_owned(job):
+            return False
+        job.update(fields)
+        c.execute("UPDATE broadcast_jobs SET data = ? WHERE key = ?", (json.dumps(job, ensure_ascii=False), job_key))
+    return True
+
+@storage_op
+def finish_broadcast_job(job_key: str) -> bool:
+    """Remove a job this worker holds. Returns False if another worker owns it now."""
+    if firebase_ready() and JOBS_REF:
+        try:
+            def tx(cur):
+                if not _job_owned(cur):
+                    raise _TxAbort()
+                return None
+            JOBS_REF.child(job_key).transaction(tx)
+            return True
+        except _TxAbort:
+            return False
+        except Exception:
+            logger.exception("Firebase finish_broadcast_job failed, falling back to local.")
+            note_storage_fallback()
+    with local_tx() as c:
+        row = c.execute("SELECT data FROM broadcast_jobs WHERE key = ?", (job_key,)).fetchone()
+        if not _job_owned(json.loads(row[0]) if row else None):
+            return False
+        c.execute("DELETE FROM broadcast_jobs WHERE key = ?", (job_key,))
+    return True
+
+class JobLease:
+    """Renews a claimed job's lease from a heartbeat thread while the job runs.
+
+    A single chunk (429 pauses, slow sends, a media upload) can outlast
+    JOB_LEASE_SECONDS, so the lease is not left to the chunk checkpoints.
+    `lost` is set once a renewal finds the job gone or claimed by another
+    worker; the runner then stops without writing progress or reporting.
+    """
+
+    def __init__(self, job_key: str):
+        self.job_key = job_key
+        self.lost = threading.Event()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="broadcast-lease", daemon=True)
+
+    def __enter__(self) -> "JobLease":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._done.wait(JOB_LEASE_SECONDS / 3):
+            try:
+                owned = checkpoint_broadcast_job(self.job_key, {})
+            except Exception:
+                logger.exception("Renewing the lease on broadcast job %s failed", self.job_key)
+                continue
+            if not owned:
+                logger.warning("Lost the lease on broadcast job %s", self.job_key)
+                self.lost.set()
+                return
+
+# ---------------- Media broadcasts ----------------
+# file_ids are private to the bot that received the file, and a user bot cannot
+# copy from the owner's chat with the main bot. So a media broadcast downloads
+# the originals once through the main bot, uploads them with the user bot to
+# the first subscriber that accepts them, and every other subscriber gets the
+# user bot's own file_id: one light call each, no re-upload. The file_ids are
+# cached per bot, so the same media is never uploaded twice. Album parts and the
+# cache live in the main storage with the jobs, so any worker can run the job.
+MEDIA_METHODS = {"photo": "sendPhoto", "video": "sendVideo", "animation": "sendAnimation",
+                 "document": "sendDocument", "audio": "sendAudio", "voice": "sendVoice"}
+CAPTION_LIMIT = 1024
+MEDIA_GROUP_WAIT = int(os.getenv("MEDIA_GROUP_WAIT", "3"))  # seconds to let every album part arrive
+
+def message_media(message: dict) -> Optional[dict]:
+    """{"type", "file_id", "file_unique_id"} of the captionable media in `message`, or None."""
+    for kind in MEDIA_METHODS:  # animation before document: GIF messages carry both
+        obj = message.get(kind)
+        if kind == "photo" and obj:
+            obj = obj[-1]  # largest size
+        if obj:
+            return {"type": kind, "file_id": obj["file_id"], "file_unique_id": obj.get("file_unique_id") or obj["file_id"]}
+    return None
+
+MEDIA_GROUP_TTL = 3600  # album parts nobody broadcast are dropped after this (by the broadcast worker)
+
+@storage_op
+def save_media_group_part(group_id: str, message_id: int, item: dict):
+    """Album parts arrive as separate updates; keep them until the album's job reads them."""
+    now = int(time.time())
+    if firebase_ready() and MEDIA_GROUPS_REF:
+        try:
+            MEDIA_GROUPS_REF.child(str(group_id)).update({f"parts/{int(message_id)}": item, "received_at": now})
+            return
+        except Exception:
+            logger.exception("Firebase save_media_group_part failed, falling back to local.")
+            note_storage_fallback()
+    with local_tx() as c:
+        c.execute("INSERT OR REPLACE INTO media_group_parts (group_id, message_id, data, received_at) VALUES (?, ?, ?, ?)",
+                  (str(group_id), int(message_id), json.dumps(item), now))
+
+@storage_op
+def media_group_items(group_id: str) -> List[dict]:
+    if firebase_ready() and MEDIA_GROUPS_REF:
+        try:
+            parts = MEDIA_GROUPS_REF.child(str(group_id)).child("parts").get() or {}
+            if isinstance(parts, list):  # Firebase returns small integer-keyed maps as lists
+                parts = {i: p for i, p in enumerate(parts) if p}
+            return [parts[k] for k in sorted(parts, key=int)]
+        except Exception:
+            logger.exception("Firebase media_group_items failed, falling back to local.")
+            note_storage_fallback()
+    rows = local_db().execute("SELECT data FROM media_group_parts WHERE group_id = ? ORDER BY message_id",
+                              (str(group_id),)).fetchall()
+    return [json.loads(r[0]) for r in rows]
+
+@storage_op
+def prune_media_groups() -> int:
+    """Drop album parts older than MEDIA_GROUP_TTL. Returns the number of albums removed."""
+    cutoff = int(time.time()) - MEDIA_GROUP_TTL
+    if firebase_ready() and MEDIA_GROUPS_REF:
+        try:
+            stale = [gid for gid in (MEDIA_GROUPS_REF.get(shallow=True) or {})
+                     if int(MEDIA_GROUPS_REF.child(gid).child("received_at").get() or 0) < cutoff]
+            if stale:
+                MEDIA_GROUPS_REF.update({gid: None for gid in stale})
+            return len(stale)
+        except Exception:
+            logger.exception("Firebase prune_media_groups failed, falling back to local.")
+            note_storage_fallback()
+    with local_tx() as c:
+        return c.execute("DELETE FROM media_group_parts WHERE received_at < ?", (cutoff,)).rowcount
+
+@storage_op
+def cached_file_ids(bot_id: int, items: List[dict]) -> Optional[List[str]]:
+    """The bot's own file_ids for `items`, or None unless every one is cached."""
+    if firebase_ready() and MEDIA_CACHE_REF:
+        try:
+            ids = [MEDIA_CACHE_REF.child(str(int(bot_id))).child(it["file_unique_id"]).get() for it in items]
+            return ids if all(ids) else None
+        except Exception:
+            logger.exception("Firebase cached_file_ids failed, falling back to local.")
+            note_storage_fallback()
+    c = local_db()
+    ids = []
+    for it in items:
+        row = c.execute("SELECT file_id FROM media_cache WHERE bot_id = ? AND file_unique_id = ?",
+                        (int(bot_id), it["file_unique_id"])).fetchone()
+        if not row:
+            return None
+        ids.append(row[0])
+    return ids
+
+@storage_op
+def cache_file_ids(bot_id: int, items: List[dict], file_ids: List[str]):
+    if firebase_ready() and MEDIA_CACHE_REF:
+        try:
+            MEDIA_CACHE_REF.child(str(int(bot_id))).update(
+                {it["file_unique_id"]: fid for it, fid in zip(items, file_ids)})
+            return
+        except Exception:
+            logger.exception("Firebase cache_file_ids failed, falling back to local.")
+            note_storage_fallback()
+    with local_tx() as c:
+        c.executemany("INSERT OR REPLACE INTO media_cache (bot_id, file_unique_id, file_id) VALUES (?, ?, ?)",
+                      [(int(bot_id), it["file_unique_id"], fid) for it, fid in zip(items, file_ids)])
+
+def media_request(items: List[dict], caption: str, refs: List[str]) -> Tuple[str, Dict[str, Any]]:
+    """(method, payload) sending `items` with `caption`; refs are file_ids or attach://names."""
+    extra = {"caption": caption, "parse_mode": "HTML"} if caption else {}
+    if len(items) == 1:
+        return MEDIA_METHODS[items[0]["type"]], dict(extra, **{items[0]["type"]: refs[0]})
+    media = [{"type": it["type"], "media": ref} for it, ref in zip(items, refs)]
+    media[0].update(extra)  # an album shows the first item's caption
+    return "sendMediaGroup", {"media": media}
+
+def download_media(items: List[dict]) -> Optional[List[Tuple[str, bytes]]]:
+    files = []
+    for it in items:
+        f = download_file(BOT_TOKEN, it["file_id"])
+        if f is None:
+            return None
+        files.append(f)
+    return files
+
+def upload_media(token: str, items: List[dict], caption: str, files: List[Tuple[str, bytes]],
+                 chat_ids: List[int], limiter: RateLimiter, stats: Dict[str, Any],
+                 stop: threading.Event) -> Tuple[Optional[List[str]], int]:
+    """Upload the media to the first of `chat_ids` that accepts it.
+
+    Every chat tried is counted in `stats` like any delivery. Returns (the
+    bot's file_ids, chats tried); file_ids is None if all of them were dead
+    or an upload failed for another reason (then fewer were tried), or once
+    `stop` is set.
+    """
+    names = [f"m{i}" for i in range(len(items))]
+    if len(items) == 1:
+        method, payload = media_request(items, caption, [""])
+        payload.pop(items[0]["type"])
+        parts = {items[0]["type"]: files[0]}
+    else:
+        method, payload = media_request(items, caption, [f"attach://{n}" for n in names])
+        parts = dict(zip(names, files))
+    for tried, cid in enumerate(chat_ids, 1):
+        if stop.is_set():
+            return None, tried - 1
+        outcome, res = _broadcast_one(token, int(cid), method, payload, limiter, files=parts)
+        BROADCAST_MESSAGES.labels(outcome).inc()
+        stats[outcome] += 1
+        if outcome == "sent":
+            sent = res.get("result")
+            sent = sent if isinstance(sent, list) else [sent]
+            return [message_media(m)["file_id"] for m in sent], tried
+        if outcome not in DEAD_OUTCOMES:
+            logger.warning("Media upload to %s failed: %s", cid, res.get("description") or res.get("error"))
+            return None, tried
+        stats["dead"].append(int(cid))
+    return None, len(chat_ids)
+
+def run_broadcast_job(job_key: str, job: dict):
+    """Send a claimed job from its checkpoint onwards, saving progress every JOB_CHUNK subscribers.
+
+    The lease is renewed by a JobLease heartbeat; if it is lost the run stops
+    and the worker that took the job over finishes and reports it.
+    """
+    owner_chat = job.get("owner_chat")
+
+    def end(message: str):
+        if finish_broadcast_job(job_key):
+            send_main_message(owner_chat, message)
+
+    rec = get_bot_by_key(job.get("bot_key", ""))
+    if not rec:
+        end("Бот табылмады, тарату тоқтатылды.")
+        return
+    try:
+        tok = bot_token(job["bot_key"], rec)
+    except Exception:
+        end("Токенді дешифрлеу сәтсіз.")
+        return
+
+    text = job.get("text", "")
+    items = job.get("media") or (media_group_items(job["media_group"]) if job.get("media_group") else None)
+    if job.get("media_group") and not items:
+        end("Альбом табылмады, тарату тоқтатылды.")
+        return
+    file_ids = (job.get("file_ids") or cached_file_ids(rec.get("bot_id", 0), items)) if items else None
+    files = None
+
+    totals = {f: int(job.get(f, 0)) for f in DELIVERY_OUTCOMES + ("pruned",)}
+    offset = int(job.get("offset", 0))
+    cursor = job.get("cursor")
+    # subscriber ids are resumed by key, so people who subscribe mid-job do not shift the checkpoint
+    subs = iter_subscribers(job["bot_key"], after=int(cursor) if cursor is not None else None)
+    limiter = RateLimiter(BROADCAST_RATE)
+    with JobLease(job_key) as lease:
+        while not lease.lost.is_set():
+            chunk = list(itertools.islice(subs, JOB_CHUNK))
+            if not chunk:
+                break
+            stats: Dict[str, Any] = {o: 0 for o in DELIVERY_OUTCOMES}
+            stats["dead"] = []
+            rest = chunk
+            if items and not file_ids:
+                files = files or download_media(items)
+                if files is None:
+                    end("Медиа файлды алу сәтсіз (бот 20 МБ-тан үлкен файлды жүктей алмайды).")
+                    return
+                file_ids, tried = upload_media(tok, items, text, files, chunk, limiter, stats, lease.lost)
+                rest = chunk[tried:]
+                if file_ids:
+                    cache_file_ids(rec.get("bot_id", 0), items, file_ids)
+                    # a resumed job never uploads again
+                    if not checkpoint_broadcast_job(job_key, {"file_ids": file_ids}):
+                        lease.lost.set()
+                elif rest and not lease.lost.is_set():
+                    # the upload was refused for a reason other than a dead chat: it would fail for everyone
+                    done = {f: totals[f] + stats[f] for f in DELIVERY_OUTCOMES}
+                    end(broadcast_report(done) + "\nМедиа жіберу сәтсіз, тарату тоқтатылды.")
+                    return
+            if rest and not lease.lost.is_set():
+                if items:
+                    method, payload = media_request(items, text, file_ids)
+                else:
+                    method, payload = "sendMessage", {"text": text, "parse_mode": "HTML"}
+                sent = broadcast_message(tok, rest, method, payload, limiter=limiter, stop=lease.lost)
+                stats["dead"] += sent["dead"]
+                for f in DELIVERY_OUTCOMES:
+                    stats[f] += sent[f]
+            for f in DELIVERY_OUTCOMES:
+                totals[f] += stats[f]
+            if BROADCAST_PRUNE and stats["dead"]:
+                try:
+                    totals["pruned"] += remove_subscribers(job["bot_key"], stats["dead"])
+                except Exception:
+                    logger.exception("Pruning %s dead subscribers of %s failed", len(stats["dead"]), job["bot_key"])
+            if lease.lost.is_set():
+                break
+            offset += len(chunk)
+            if not checkpoint_broadcast_job(job_key, dict(totals, cursor=chunk[-1], offset=offset, file_ids=file_ids)):
+                lease.lost.set()
+    if lease.lost.is_set():
+        logger.warning("Broadcast job %s was taken over by another worker; stopping", job_key)
+        return
+    end(broadcast_report(totals))
+
+def broadcast_report(totals: Dict[str, int]) -> str:
+    report = f"✅ {totals['sent']} адамға жіберілді."
+    for field, label in (("blocked", "Ботты бұғаттағандар"), ("not_found", "Чат табылмады"),
+                         ("throttled", "Шектеу (429)"), ("network", "Желі қатесі"),
+                         ("failed", "Басқа қателер"), ("pruned", "Тізімнен өшірілді")):
+        if totals.get(field):
+            report += f"\n{label}: {totals[field]}"
+    return report
+
+def run_broadcast_worker(stop: Optional[threading.Event] = None):
+    """Poll the job queue and run jobs until `stop` is set; prune stale album parts hourly when idle."""
+    stop = stop or threading.Event()
+    logger.info("Broadcast worker %s started", WORKER_ID)
+    pruned_at = 0.0
+    while not stop.is_set():
+        try:
+            claimed = claim_broadcast_job()
+        except Exception:
+            logger.exception("claim_broadcast_job error")
+            claimed = None
+        if claimed:
+            job_key, job = claimed
+            try:
+                run_broadcast_job(job_key, job)
+            except Exception:
+                # lease will expire and another worker (or this one) resumes from the checkpoint
+                logger.exception("Broadcast job %s failed", job_key)
+            continue
+        if time.time() - pruned_at > MEDIA_GROUP_TTL:
+            pruned_at = time.time()
+            try:
+                prune_media_groups()
+            except Exception:
+                logger.exception("prune_media_groups error")
+        _job_wakeup.wait(JOB_POLL_SECONDS)
+        _job_wakeup.clear()
+
+_worker_thread: Optional[threading.Thread] = None
+_worker_start_lock = threading.Lock()
+
+def start_inline_broadcast_worker():
+    global _worker_thread
+    if _worker_thread and _worker_thread.is_alive():
+        return
+    with _worker_start_lock:
+        if _worker_thread and _worker_thread.is_alive():
+            return
+        _worker_thread = threading.Thread(target=run_broadcast_worker, name="broadcast-worker", daemon=True)
+        _worker_thread.start()
+
+# ----------------- autopost scheduler ----------------
+# Bots with autopost_enabled re-post their autopost_template every
+# autopost_interval seconds. Due times live on the bot record (autopost_next),
+# in autopost_index (DB key -> due time, only bots that autopost) and in a heap
+# keyed by due time, so each wakeup costs O(log n) and a rescan reads the index,
+# not every bot. One process per host holds AUTOPOST_LOCK_PATH and schedules; each run
+# becomes an ordinary broadcast job whose key names the slot, so a run enqueued
+# twice is still sent once.
+AUTOPOST_MODE = os.getenv("AUTOPOST_MODE", "inline")                  # inline | external | off
+AUTOPOST_MIN_INTERVAL = int(os.getenv("AUTOPOST_MIN_INTERVAL", "600"))
+AUTOPOST_RESCAN_SECONDS = int(os.getenv("AUTOPOST_RESCAN_SECONDS", "300"))  # pick up /autoposting changes
+AUTOPOST_LOCK_PATH = os.getenv("AUTOPOST_LOCK_PATH", os.path.join(tempfile.gettempdir(), "manybot-autopost.lock"))
+
+def parse_interval(s: str) -> Optional[int]:
+    """"90", "90m", "2h", "1d" -> seconds (bare numbers are minutes); None if unparsable."""
+    m = re.fullmatch(r"(\d+)\s*([mhd]?)", (s or "").strip().lower())
+    if not m:
+        return None
+    return int(m.group(1)) * {"": 60, "m": 60, "h": 3600, "d": 86400}[m.group(2)]
+
+def autopost_due(rec: dict) -> Optional[int]:
+    """When this bot should post next, or None if autoposting is off or incomplete."""
+    if not rec.get("autopost_enabled") or not rec.get("autopost_template") or not rec.get("autopost_interval"):
+        return None
+    return int(rec.get("autopost_next") or 0)
+
+@storage_op
+def set_autopost_due(key: str, due: Optional[int]):
+    """Record a bot's next autopost in autopost_index; None takes it out."""
+    if firebase_ready() and AUTOPOST_INDEX_REF:
+        try:
+            if due is None:
+                AUTOPOST_INDEX_REF.child(key).delete()
+            else:
+                AUTOPOST_INDEX_REF.child(key).set(int(due))
+            return
+        except Exception:
+            logger.exception("Firebase set_autopost_due failed, falling back to local.")
+            note_storage_fallback()
+    with local_tx() as c:
+        if due is None:
+            c.execute("DELETE FROM autopost_index WHERE key = ?", (key,))
+        else:
+            c.execute("INSERT OR REPLACE INTO autopost_index (key, due) VALUES (?, ?)", (key, int(due)))
+
+@storage_op
+def get_autopost_index() -> Dict[str, int]:
+    if firebase_ready() and AUTOPOST_INDEX_REF:
+        try:
+            idx = AUTOPOST_INDEX_REF.get() or {}
+            return {k: int(v) for k, v in (idx.items() if isinstance(idx, dict) else [])}
+        except Exception:
+            logger.exception("Firebase get_autopost_index failed, falling back to local.")
+            note_storage_fallback()
+    return dict(local_db().execute("SELECT key, due FROM autopost_index").fetchall())
+
+def build_autopost_index() -> int:
+    """Rebuild autopost_index from the bot records. Returns the number of indexed bots."""
+    idx: Dict[str, int] = {}
+    for page in iter_bot_pages():
+        for key, rec in page:
+            due = autopost_due(rec) if isinstance(rec, dict) else None
+            if due is not None:
+                idx[key] = due
+    if firebase_ready() and AUTOPOST_INDEX_REF:
+        AUTOPOST_INDEX_REF.set(idx)
+    else:
+        with local_tx() as c:
+            c.execute("DELETE FROM autopost_index")
+            c.executemany("INSERT INTO autopost_index (key, due) VALUES (?, ?)", idx.items())
+    return len(idx)
+
+def run_autopost(key: str, slot: int, now: float) -> Optional[int]:
+    """Enqueue the run due at `slot` and return the next due time (None = stop scheduling).
+
+    After downtime only one catch-up run is sent for all missed slots; the
+    schedule then continues from the first slot after `now`.
+    """
+    rec = _load_bot_by_key(key)  # not the cache: an /autoposting off on another worker must count
+    due = autopost_due(rec) if rec else None
+    if due != slot:
+        # disabled, deleted or rescheduled since the heap entry was made; the next rescan has it
+        set_autopost_due(key, due)
+        return None
+    interval = max(int(rec["autopost_interval"]), AUTOPOST_MIN_INTERVAL)
+    tpl = get_template(rec["autopost_template"])
+    if tpl and int(tpl.get("owner", 0)) == int(rec.get("owner", -1)):
+        text = tpl.get("content") or tpl.get("title") or ""
+        if text and enqueue_broadcast(f"autopost_{key}_{slot}", key, rec["owner"], text):
+            logger.info("Autopost for %s queued (slot %s)", key, slot)
+    else:
+        logger.warning("Autopost template %s of %s is missing", rec.get("autopost_template"), key)
+    nxt = slot + interval
+    if nxt <= now:
+        nxt += ((int(now) - nxt) // interval + 1) * interval
+    update_bot_field(key, "autopost_next", nxt)
+    set_autopost_due(key, nxt)
+    return nxt
+
+class AutopostScheduler:
+    """Heap of (due time, bot key); rebuilt from autopost_index every AUTOPOST_RESCAN_SECONDS."""
+
+    def __init__(self):
+        self.heap: List[Tuple[int, str]] = []
+        self.rescan_at = 0.0
+
+    def rescan(self):
+        heap = [(due, key) for key, due in get_autopost_index().items()]
+        heapq.heapify(heap)
+        self.heap = heap
+        self.rescan_at = time.time() + AUTOPOST_RESCAN_SECONDS
+        logger.info("Autopost scheduler tracking %s bots", len(heap))
+
+    def run_due(self, now: float):
+        while self.heap and self.heap[0][0] <= now:
+            slot, key = heapq.heappop(self.heap)
+            try:
+                nxt = run_autopost(key, slot, now)
+            except Exception:
+                logger.exception("Autopost for %s failed", key)
+                nxt = slot + AUTOPOST_MIN_INTERVAL
+            if nxt is not None:
+                heapq.heappush(self.heap, (nxt, key))
+
+    def run(self, stop: threading.Event):
+        while not stop.is_set():
+            now = time.time()
+            if now >= self.rescan_at:
+                try:
+                    self.rescan()
+                except Exception:
+                    logger.exception("Autopost rescan failed")
+                    self.rescan_at = now + JOB_POLL_SECONDS
+            self.run_due(now)
+            wake = min(self.rescan_at, self.heap[0][0] if self.heap else self.rescan_at)
+            stop.wait(max(0.0, min(wake - time.time(), AUTOPOST_RESCAN_SECONDS)))
+
+def run_autopost_scheduler(stop: Optional[threading.Event] = None):
+    """Become the host's autopost leader (waiting for the lock if needed) and schedule until `stop`."""
+    stop = stop or threading.Event()
+    with open(AUTOPOST_LOCK_PATH, "w") as lock:
+        while not stop.is_set():
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                stop.wait(AUTOPOST_RESCAN_SECONDS / 10)
+        else:
+            return
+        logger.info("Autopost scheduler %s is leader", WORKER_ID)
+        AutopostScheduler().run(stop)
+
+_autopost_thread: Optional[threading.Thread] = None
+
+def start_inline_autopost_scheduler():
+    global _autopost_thread
+    if _autopost_thread and _autopost_thread.is_alive():
+        return
+    with _worker_start_lock:
+        if _autopost_thread and _autopost_thread.is_alive():
+            return
+        _autopost_thread = threading.Thread(target=run_autopost_scheduler, name="autopost", daemon=True)
+        _autopost_thread.start()
+
+def start_background_work():
+    """Start the inline broadcast worker and autopost scheduler (each at most once)."""
+    if BROADCAST_WORKER_MODE == "inline":
+        start_inline_broadcast_worker()
+    if AUTOPOST_MODE == "inline":
+        start_inline_autopost_scheduler()
+
+# ----------------- subscriber write-behind ----------------
+# /start on a user bot only queues the subscriber; a background thread writes the
+# queue in one batch every SUBSCRIBE_FLUSH_MS or once SUBSCRIBE_FLUSH_MAX entries wait.
+SUBSCRIBE_WRITE_BEHIND = os.getenv("SUBSCRIBE_WRITE_BEHIND", "1") == "1"
+SUBSCRIBE_FLUSH_MS = int(os.getenv("SUBSCRIBE_FLUSH_MS", "500"))
+SUBSCRIBE_FLUSH_MAX = int(os.getenv("SUBSCRIBE_FLUSH_MAX", "500"))
+SUBSCRIBE_SEEN_MAX = int(os.getenv("SUBSCRIBE_SEEN_MAX", "100000"))
+
+class SubscriberBuffer:
+    """Batches new subscribers and drops repeat /starts from already stored ones."""
+
+    def __init__(self, flush_ms: int = SUBSCRIBE_FLUSH_MS, max_pending: int = SUBSCRIBE_FLUSH_MAX,
+                 seen_max: int = SUBSCRIBE_SEEN_MAX):
+        self.flush_interval = flush_ms / 1000.0
+        self.max_pending = max_pending
+        self.seen_max = seen_max
+        self._pending: "OrderedDict[Tuple[str, int], None]" = OrderedDict()
+        self._seen: "OrderedDict[Tuple[str, int], None]" = OrderedDict()  # LRU of stored pairs
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, bot_key: str, user_id: int) -> bool:
+        """Queue a subscriber; returns False if it is already stored or queued."""
+        item = (bot_key, int(user_id))
+        with self._cond:
+            if item in self._seen:
+                self._seen.move_to_end(item)
+                return False
+            if item in self._pending:
+                return False
+            self._pending[item] = None
+            if len(self._pending) >= self.max_pending:
+                self._cond.notify()
+            if not (self._thread and self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run, name="subscriber-flush", daemon=True)
+                self._thread.start()
+        return True
+
+    def forget(self, bot_key: str, user_ids: Iterable[int]):
+        """Drop removed subscribers from the seen set so a later /start stores them again."""
+        with self._cond:
+            for u in user_ids:
+                self._seen.pop((bot_key, int(u)), None)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                batch = list(self._pending)
+                self._pending.clear()
+            if not batch:
+                return
+            try:
+                add_subscribers_bulk(batch)
+            except Exception:
+                logger.exception("Subscriber flush of %s entries failed; requeueing", len(batch))
+                with self._cond:
+                    for item in batch:
+                        self._pending[item] = None
+                return
+            with self._cond:
+                for item in batch:
+                    self._seen[item] = None
+                while len(self._seen) > self.seen_max:
+                    self._seen.popitem(last=False)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._pending) < self.max_pending:
+                    self._cond.wait(self.flush_interval)
+            self.flush()
+
+subscriber_buffer = SubscriberBuffer()
+atexit.register(subscriber_buffer.flush)
+
+def register_subscriber(bot_key: str, user_id: int):
+    if SUBSCRIBE_WRITE_BEHIND:
+        subscriber_buffer.add(bot_key, user_id)
+    else:
+        add_subscriber(bot_key, user_id)
 
 # ----------------- encryption helpers ----------------
 def encrypt_token(plain: str) -> str:
@@ -374,502 +2155,954 @@ def decrypt_token(enc: str) -> str:
         logger.exception("decrypt_token failed")
         raise
 
+# DB key -> (ciphertext, plaintext). A cached entry is used only while the stored
+# ciphertext still matches, so a re-encrypted or replaced token is decrypted afresh.
+token_cache = TTLCache("tokens", ttl=float(os.getenv("TOKEN_CACHE_TTL", "3600")))
+
+def bot_token(key: str, rec: dict) -> str:
+    """Plain token for a bot record; raises like decrypt_token on a bad key."""
+    enc = rec.get("token") or ""
+    if not fernet:
+        return enc
+    hit = token_cache.get(key)
+    if hit is not _MISSING and hit[0] == enc:
+        return hit[1]
+    plain = decrypt_token(enc)
+    token_cache.set(key, (enc, plain))
+    return plain
+
+def reencrypt_tokens(batch: int = 200) -> Dict[str, int]:
+    """Re-encrypt every stored token with the newest MASTER_KEY, one page of bots at a time.
+
+    Tokens stored in plain text (before MASTER_KEY was set) are encrypted as well.
+    """
+    if not fernet:
+        raise RuntimeError("MASTER_KEY is not configured")
+    stats = {"rotated": 0, "failed": 0}
+
+    def rotate(rec: dict) -> Optional[str]:
+        enc = rec.get("token") or ""
+        try:
+            return fernet.rotate(enc.encode()).decode()
+        except InvalidToken:
+            if ":" in enc:  # looks like a plain BotFather token
+                return encrypt_token(enc)
+            stats["failed"] += 1
+            return None
+
+    for page in iter_bot_pages(batch):
+        updates = {}
+        for k, rec in page:
+            if isinstance(rec, dict):
+                new = rotate(rec)
+                if new:
+                    updates[k] = new
+        if updates:
+            if firebase_ready() and ROOT_REF:
+                ROOT_REF.update({f"bots/{k}/token": v for k, v in updates.items()})
+            else:
+                with local_tx() as c:
+                    for k, v in updates.items():
+                        row = c.execute("SELECT data FROM bots WHERE key = ?", (k,)).fetchone()
+                        if row:
+                            c.execute("UPDATE bots SET data = ? WHERE key = ?",
+                                      (json.dumps(dict(json.loads(row[0]), token=v), ensure_ascii=False), k))
+            for k in updates:
+                bot_cache.invalidate(k)
+                token_cache.invalidate(k)
+            stats["rotated"] += len(updates)
+    return stats
+
 # ----------------- user prefs (local) ----------------
 # store simple user preferences like language
+@local_storage_op
 def set_user_pref(user_id: int, key: str, value: Any):
-    d = read_local("users")
-    if str(user_id) not in d:
-        d[str(user_id)] = {}
-    d[str(user_id)][key] = value
-    write_local("users", d)
+    pref_cache.invalidate((int(user_id), key))
+    with local_tx() as c:
+        c.execute("INSERT OR REPLACE INTO users (user_id, pref, value) VALUES (?, ?, ?)",
+                  (int(user_id), key, json.dumps(value)))
 
+@local_storage_op
 def get_user_pref(user_id: int, key: str, default=None):
-    d = read_local("users")
-    return d.get(str(user_id), {}).get(key, default)
+    v = pref_cache.get((int(user_id), key))
+    if v is _MISSING:
+        row = local_db().execute("SELECT value FROM users WHERE user_id = ? AND pref = ?", (int(user_id), key)).fetchone()
+        v = json.loads(row[0]) if row else None
+        pref_cache.set((int(user_id), key), v)
+    return default if v is None else v
+
+# ----------------- /templates pagination -----------------
+TEMPLATE_PREVIEW_CHARS = 600
+
+def render_templates_page(owner: int, cursor: Optional[str] = None, backwards: bool = False) -> tuple:
+    """Build the text and inline keyboard for one /templates page."""
+    temps, has_prev, has_next = get_templates_page(owner, cursor, backwards)
+    if not temps:
+        return "Шаблондар жоқ.", None
+    out = ""
+    for k, v in temps:
+        content = v.get("content") or ""
+        if len(content) > TEMPLATE_PREVIEW_CHARS:
+            content = content[:TEMPLATE_PREVIEW_CHARS] + "…"
+        out += f"ID:{k}\n{v.get('title')}\n{content}\n\n"
+    buttons = []
+    if has_prev:
+        buttons.append({"text": "⬅️", "callback_data": f"tpl:p:{temps[0][0]}"})
+    if has_next:
+        buttons.append({"text": "➡️", "callback_data": f"tpl:n:{temps[-1][0]}"})
+    markup = {"inline_keyboard": [buttons]} if buttons else None
+    return out[:4000], markup
+
+def handle_callback_query(cq: dict, outbox: Optional[Outbox] = None):
+    data = cq.get("data") or ""
+    user_id = (cq.get("from") or {}).get("id")
+    msg = cq.get("message") or {}
+    if data.startswith("tpl:") and user_id and msg:
+        _, direction, cursor = data.split(":", 2)
+        out, markup = render_templates_page(user_id, cursor, backwards=(direction == "p"))
+        payload = {"chat_id": msg.get("chat", {}).get("id"), "message_id": msg.get("message_id"), "text": out}
+        if markup:
+            payload["reply_markup"] = markup
+        deliver(outbox, BOT_TOKEN, "editMessageText", payload)
+    deliver(outbox, BOT_TOKEN, "answerCallbackQuery", {"callback_query_id": cq.get("id")})
+
+# ----------------- Main bot command router -----------------
+# Commands are registered in COMMANDS; the webhook parses the command word once
+# and dispatches with a dict lookup instead of walking a startswith() chain.
+class CommandContext:
+    """One incoming main-bot message plus the reply helper handlers use."""
+
+    def __init__(self, message: dict, outbox: Optional[Outbox] = None):
+        self.message = message
+        self.outbox = outbox
+        self.chat = message.get("chat", {}) or {}
+        self.chat_id = self.chat.get("id")
+        self.text = (message.get("text") or "").strip()
+        self.user_id = (message.get("from", {}) or {}).get("id")
+        self.command = parse_command(self.text)
+
+    def reply(self, text: str, parse_mode: Optional[str] = None, **extra) -> Dict[str, Any]:
+        payload = {"chat_id": self.chat_id, "text": text}
+        if parse_mode:
+            payload["parse_mode"] = parse_mode
+        payload.update(extra)
+        return deliver(self.outbox, BOT_TOKEN, "sendMessage", payload)
+
+    def owns(self, rec: dict) -> bool:
+        return int(rec.get("owner")) == int(self.user_id) or is_admin(self.user_id)
+
+COMMANDS: Dict[str, Any] = {}
+
+def command(*names: str):
+    """Register a handler for one or more /commands."""
+    def deco(fn):
+        for name in names:
+            COMMANDS[name] = fn
+        return fn
+    return deco
+
+def parse_command(text: str) -> Optional[str]:
+    """"/cmd@ManyBot args" -> "/cmd"; None when the text is not a command."""
+    if not text.startswith("/"):
+        return None
+    return text.split(None, 1)[0].split("@", 1)[0].lower()
+
+@command("/start")
+def cmd_start(ctx: CommandContext):
+    reply = (
+        "Сәлем! ManyBot KZ 🇰🇿\n\n"
+        "Командалар:\n"
+        "/addbot — жаңа бот қосу\n"
+        "/token <TOKEN> — BotFather-дан алынған токенді жіберу (тек жеке чат)\n"
+        "/bots — өз боттарың\n"
+        "/newpost — хабар тарату (ID + мәтін)\n"
+        "/setdescription — бот сипаттамасын орнату\n"
+        "/autoposting — autopost режимін қосу/өшіру\n"
+        "/botlang — боттың тілін орнату\n"
+        "/subscribers — жалпы жазылушылар саны\n"
+        "/templates — шаблондар\n"
+        "/addtemplate — шаблон қосу\n"
+        "/admins — админдер тізімі\n"
+        "/lang — өзіңнің тіл таңдауыңды орнату\n"
+        "/deletebot — ботты өшіру\n"
+        "/help — көмек\n"
+    )
+    if BOT_TOKEN:
+        ctx.reply(reply, parse_mode="HTML")
+
+@command("/help")
+def cmd_help(ctx: CommandContext):
+    help_text = (
+        "<b>ManyBot KZ командалары</b>\n"
+        "/addbot — жаңа бот қосу (private чатта /token жібер)\n"
+        "/token <TOKEN> — токен жіберу\n"
+        "/bots — өз боттарыңызды көру\n"
+        "/deletebot <DB_KEY> — ботты өшіру\n"
+        "/newpost — хабар тарату (бір хабарда: DB_KEY\\nМӘТІН)\n"
+        "/setdescription — бот сипаттамасын орнату (бір хабарда: /setdescription\\nDB_KEY\\nDESCRIPTION)\n"
+        "/autoposting — қосу/өшіру (бір хабарда: /autoposting\\nDB_KEY\\non TEMPLATE_KEY 2h|off)\n"
+        "/botlang — бот тілін орнату (мысалы: /botlang DB_KEY kk|ru|en)\n"
+        "/subscribers — жазылушылар саны\n"
+        "/admins — админдер тізімі (тізім көрсету)\n"
+        "/lang — өз тіл таңдауыңды орнату (мысалы: /lang kk)\n"
+        "/addtemplate — шаблон қосу (бір хабарда: /addtemplate\\nTITLE\\nCONTENT)\n"
+        "/templates — менің шаблондар\n"
+    )
+    if BOT_TOKEN:
+        ctx.reply(help_text, parse_mode="HTML")
+
+@command("/addbot")
+def cmd_addbot(ctx: CommandContext):
+    ctx.reply("Bot қосу: BotFather арқылы бот жасаңыз да, жеке чатта төмендегі командамен токенді жіберіңіз:\n\n/token <BOT_TOKEN>")
+
+# token handler (only in private)
+@command("/token")
+def cmd_token(ctx: CommandContext):
+    if ctx.chat.get("type") != "private":
+        ctx.reply("Токенді тек жеке чатта жіберіңіз.")
+        return
+    parts = ctx.text.split(None, 1)
+    token = parts[1].strip() if len(parts) > 1 else ""
+    if ":" not in token:
+        ctx.reply("Токен форматы қате.")
+        return
+    # progress note goes out now, ahead of the slow getMe below
+    send_main_message(ctx.chat_id, "Токен тексерілуде...")
+    me = get_me(token)
+    if not me:
+        ctx.reply("Токен жарамсыз немесе Telegram қол жетімсіз.")
+        return
+    # save bot
+    key = save_bot_record(owner=ctx.user_id, bot_id=me.get("id"), username=me.get("username"), token_plain=token)
+    # set webhook for user bot to our /b/<DB_KEY>
+    webhook_url = None
+    if WEBHOOK_BASE_URL:
+        webhook_url = user_bot_webhook_url(key)
+        set_res = set_webhook_for_token(token, webhook_url, secret_token=webhook_secret(key),
+                                        allowed_updates=USER_BOT_ALLOWED_UPDATES)
+        logger.info("Set webhook for user bot result: %s", set_res)
+    reply = f"✅ @{me.get('username')} қосылды!\nDB_KEY: {key}"
+    if webhook_url:
+        reply += f"\nWebhook: {webhook_url}"
+    ctx.reply(reply)
+
+# /bots - show user's bots
+@command("/bots")
+def cmd_bots(ctx: CommandContext):
+    my = list(get_bots_by_owner(ctx.user_id).items())
+    if not my:
+        ctx.reply("Сіздің қосқан ботыңыз жоқ.")
+        return
+    out = "Сіздің боттарыңыз:\n\n"
+    for k, v in my:
+        out += f"DB_KEY: <code>{k}</code>\n@{v.get('username','')}\nОписание: {v.get('description','')}\nАвто: {v.get('autopost_enabled', False)}\nЯзык: {v.get('bot_lang','kk')}\nЖазылушылар: {count_subscribers(k)}\n\n"
+    ctx.reply(out, parse_mode="HTML")
+
+# /deletebot <key>
+@command("/deletebot")
+def cmd_deletebot(ctx: CommandContext):
+    parts = ctx.text.split()
+    if len(parts) < 2:
+        ctx.reply("Қолдану: /deletebot <DB_KEY>")
+        return
+    key = parts[1].strip()
+    rec = get_bot_by_key(key)
+    if not rec:
+        ctx.reply("Бот табылмады.")
+        return
+    if not ctx.owns(rec):
+        ctx.reply("Бұл бот сізге тиесілі емес.")
+        return
+    # try delete webhook
+    try:
+        delete_webhook_for_token(bot_token(key, rec))
+    except Exception:
+        logger.exception("delete webhook attempt failed")
+    delete_bot_by_key(key)
+    ctx.reply("✅ Бот жойылды.")
+
+# /newpost - explanation
+@command("/newpost")
+def cmd_newpost(ctx: CommandContext):
+    ctx.reply("Хабар тарату үшін бір хабарда келесі форматты жіберіңіз:\n<DB_KEY>\n<мәтін>\n\n"
+              "Фото, видео, құжат немесе альбом тарату үшін сипаттаманың бірінші жолына DB_KEY жазыңыз.")
+
+# /setdescription - set bot description
+@command("/setdescription")
+def cmd_setdescription(ctx: CommandContext):
+    # expected format: /setdescription\n<DB_KEY>\n<DESCRIPTION>
+    parts = ctx.text.split("\n", 2)
+    if len(parts) < 3:
+        ctx.reply("Қолдану:\n/setdescription\n<DB_KEY>\n<DESCRIPTION>")
+        return
+    _, db_key, desc = parts
+    rec = get_bot_by_key(db_key.strip())
+    if not rec:
+        ctx.reply("DB_KEY табылмады.")
+        return
+    if not ctx.owns(rec):
+        ctx.reply("Сіз бұл боттың иесі емессіз.")
+        return
+    update_bot_field(db_key.strip(), "description", desc.strip())
+    ctx.reply("✅ Сипаттама сақталды.")
+
+# /autoposting - enable/disable autopost for bot
+AUTOPOST_USAGE = "Қолдану:\n/autoposting\n<DB_KEY>\non <TEMPLATE_KEY> <интервал: 30m|2h|1d>\nнемесе: off"
+
+@command("/autoposting")
+def cmd_autoposting(ctx: CommandContext):
+    # expected format: /autoposting\n<DB_KEY>\n<on [TEMPLATE_KEY INTERVAL]|off>
+    parts = ctx.text.split("\n", 2)
+    if len(parts) < 3:
+        ctx.reply(AUTOPOST_USAGE)
+        return
+    _, db_key, flag_line = parts
+    db_key = db_key.strip()
+    args = flag_line.split()
+    flag = args[0].lower() if args else ""
+    rec = get_bot_by_key(db_key)
+    if not rec:
+        ctx.reply("DB_KEY табылмады.")
+        return
+    if not ctx.owns(rec):
+        ctx.reply("Сіз бұл боттың иесі емессіз.")
+        return
+    if flag in ("on", "enable", "true", "1"):
+        # template and interval may be omitted when re-enabling a configured bot
+        tpl_key = args[1] if len(args) > 1 else rec.get("autopost_template")
+        interval = parse_interval(args[2]) if len(args) > 2 else rec.get("autopost_interval")
+        if not tpl_key or not interval:
+            ctx.reply(AUTOPOST_USAGE)
+            return
+        tpl = get_template(tpl_key)
+        if not tpl or int(tpl.get("owner", 0)) != int(rec.get("owner")):
+            ctx.reply("Шаблон табылмады (/templates).")
+            return
+        if interval < AUTOPOST_MIN_INTERVAL:
+            ctx.reply(f"Ең аз интервал: {AUTOPOST_MIN_INTERVAL // 60} минут.")
+            return
+        update_bot_field(db_key, "autopost_template", tpl_key)
+        update_bot_field(db_key, "autopost_interval", int(interval))
+        now = int(time.time())
+        update_bot_field(db_key, "autopost_next", now)
+        update_bot_field(db_key, "autopost_enabled", True)
+        set_autopost_due(db_key, now)
+        ctx.reply(f"✅ Autopost қосылды: «{tpl.get('title', '')}», әр {int(interval) // 60} минут сайын.")
+    elif flag in ("off", "disable", "false", "0"):
+        update_bot_field(db_key, "autopost_enabled", False)
+        set_autopost_due(db_key, None)
+        ctx.reply("✅ Autopost өшірілді.")
+    else:
+        ctx.reply(AUTOPOST_USAGE)
+
+# /botlang - set per-bot language
+@command("/botlang")
+def cmd_botlang(ctx: CommandContext):
+    # usage: /botlang <DB_KEY> <kk|ru|en>
+    parts = ctx.text.split()
+    if len(parts) < 3:
+        ctx.reply("Қолдану: /botlang <DB_KEY> <kk|ru|en>")
+        return
+    db_key = parts[1].strip()
+    lang = parts[2].strip().lower()
+    if lang not in ("kk", "ru", "en"):
+        ctx.reply("Қолдау көрсетілетін тілдер: kk, ru, en.")
+        return
+    rec = get_bot_by_key(db_key)
+    if not rec:
+        ctx.reply("DB_KEY табылмады.")
+        return
+    if not ctx.owns(rec):
+        ctx.reply("Сіз бұл боттың иесі емессіз.")
+        return
+    update_bot_field(db_key, "bot_lang", lang)
+    ctx.reply(f"✅ Боттың тілі {lang} етіп орнатылды.")
+
+# /admins - list admins
+@command("/admins")
+def cmd_admins(ctx: CommandContext):
+    admins = list_admins()
+    if not admins:
+        ctx.reply("Админдер тізімі бос.")
+    else:
+        ctx.reply("Админдер:\n" + "\n".join([str(a) for a in admins]))
 
-# ----------------- Flask app & routes -----------------
-app = Flask(__name__)
+# /cachestats - read cache hit/miss counters for this worker (admins only)
+@command("/cachestats")
+def cmd_cachestats(ctx: CommandContext):
+    if not is_admin(ctx.user_id):
+        ctx.reply("Сіз админ емессіз.")
+        return
+    lines = [f"{c['name']}: size={c['size']} hits={c['hits']} misses={c['misses']}" for c in cache_stats()]
+    ctx.reply("\n".join(lines))
+
+# /lang - set user's preferred language for ManyBot responses
+@command("/lang")
+def cmd_lang(ctx: CommandContext):
+    parts = ctx.text.split()
+    if len(parts) < 2:
+        # show current
+        cur = get_user_pref(ctx.user_id, "lang", "kk")
+        ctx.reply(f"Сіздің қазіргі тіліңіз: {cur}")
+        return
+    lang = parts[1].strip().lower()
+    if lang not in ("kk", "ru", "en"):
+        ctx.reply("Қолдау көрсетілетін тілдер: kk, ru, en.")
+        return
+    set_user_pref(ctx.user_id, "lang", lang)
+    ctx.reply(f"✅ Тіліңіз {lang} етіп орнатылды.")
+
+# /subscribers count
+@command("/subscribers")
+def cmd_subscribers(ctx: CommandContext):
+    out = f"Барлығы: {count_total_subscribers()}"
+    for k, v in get_bots_by_owner(ctx.user_id).items():
+        out += f"\n@{v.get('username','')}: {count_subscribers(k)}"
+    ctx.reply(out)
+
+# templates
+@command("/addtemplate")
+def cmd_addtemplate(ctx: CommandContext):
+    # accept multiline message after command
+    if "\n" not in ctx.text:
+        ctx.reply("Қолдану: /addtemplate\\n<TITLE>\\n<CONTENT>")
+        return
+    _, rest = ctx.text.split("\n", 1)
+    if "\n" in rest:
+        title, content = rest.split("\n", 1)
+    else:
+        title = rest.strip(); content = ""
+    save_template(ctx.user_id, title.strip() or "Без названия", content.strip())
+    ctx.reply("✅ Шаблон сақталды.")
+
+@command("/templates")
+def cmd_templates(ctx: CommandContext):
+    out, markup = render_templates_page(ctx.user_id)
+    if markup:
+        ctx.reply(out, reply_markup=markup)
+    else:
+        ctx.reply(out)
 
-@app.route("/", methods=["GET"])
-def root():
-    return "✅ ManyBot KZ running"
+# admin add/remove
+def _admin_target(ctx: CommandContext, usage: str) -> Optional[int]:
+    if not is_admin(ctx.user_id):
+        ctx.reply("Сіз админ емессіз.")
+        return None
+    parts = ctx.text.split()
+    if len(parts) < 2:
+        ctx.reply(usage)
+        return None
+    try:
+        return int(parts[1])
+    except ValueError:
+        ctx.reply("Қате user_id.")
+        return None
 
-# Main bot webhook - ManyBot main receives updates here
-@app.route(f"/{BOT_TOKEN}", methods=["POST"])
-def main_bot_webhook():
-    # This endpoint is where Telegram posts updates for the MAIN ManyBot (BOT_TOKEN)
-    update = request.get_json(silent=True)
-    if not update:
-        return jsonify({"ok": False, "error": "invalid json"}), 400
+@command("/addadmin")
+def cmd_addadmin(ctx: CommandContext):
+    new_id = _admin_target(ctx, "Қолдану: /addadmin <user_id>")
+    if new_id is not None:
+        add_admin(new_id)
+        ctx.reply(f"✅ {new_id} админ етілді.")
+
+@command("/removeadmin")
+def cmd_removeadmin(ctx: CommandContext):
+    rem = _admin_target(ctx, "Қолдану: /removeadmin <user_id>")
+    if rem is not None:
+        remove_admin(rem)
+        ctx.reply(f"✅ {rem} админдер тізімінен алынды.")
+
+# Broadcast heuristic: message contains newline and first line is a DB_KEY.
+# Media (photo, video, document, ...) carries the DB_KEY on the first line of
+# its caption; an album is one broadcast, keyed by the captioned part.
+# Firebase push ids are 20 chars of [-0-9A-Za-z_]; local keys are uuid4 hex.
+DB_KEY_RE = re.compile(r"^(?:[-0-9A-Za-z_]{20}|[0-9a-f]{32})$")
+def handle_db_key_broadcast(ctx: CommandContext) -> bool:
+    """Queue a broadcast if the first line is one of the sender's DB keys.
+
+    Ordinary chat text is rejected by the key format and the owner's cached key
+    set before anything is read from storage; admins may broadcast via any key.
+    """
+    item = message_media(ctx.message)
+    group = ctx.message.get("media_group_id") if item else None
+    source = (ctx.message.get("caption") or "").strip() if item else ctx.text
+    if not item and "\n" not in source:
+        return False
+    first, _, rest = source.partition("\n")
+    first = first.strip()
+    if not DB_KEY_RE.match(first):
+        if group and not source and (owner_bot_keys(ctx.user_id) or is_admin(ctx.user_id)):
+            # an uncaptioned album part: the captioned one may queue the album, before or after it
+            save_media_group_part(group, ctx.message.get("message_id"), item)
+        return False
+    if not owns_bot_key(ctx.user_id, first) and not is_admin(ctx.user_id):
+        return False
+    rec = get_bot_by_key(first)
+    if not rec:
+        return False
+    try:
+        bot_token(first, rec)
+    except Exception:
+        ctx.reply("Токенді дешифрлеу сәтсіз.")
+        return True
+    if item and len(rest) > CAPTION_LIMIT:
+        ctx.reply(f"Медиа сипаттамасы {CAPTION_LIMIT} таңбадан аспауы керек.")
+        return True
+    # the job key is derived from the message, so a retried update is a no-op
+    job_key = f"{ctx.chat_id}_{ctx.message.get('message_id')}"
+    if group:
+        save_media_group_part(group, ctx.message.get("message_id"), item)
+        queued = enqueue_broadcast(job_key, first, ctx.chat_id, rest, media_group=group,
+                                   not_before=int(time.time()) + MEDIA_GROUP_WAIT)
+    else:
+        queued = enqueue_broadcast(job_key, first, ctx.chat_id, rest, media=[item] if item else None)
+    if queued:
+        ctx.reply("⏳ Тарату кезекке қойылды. Аяқталғанда есеп жіберіледі.")
+    return True
+
+# ----------------- update_id dedupe -----------------
+# Telegram redelivers an update when we answer slowly or with an error. Every
+# update_id is claimed in the local SQLite file, which all workers on the host
+# share, and a second delivery inside UPDATE_DEDUPE_WINDOW is acknowledged
+# without running the handler again.
+UPDATE_DEDUPE_WINDOW = int(os.getenv("UPDATE_DEDUPE_WINDOW", "3600"))
+_dedupe_pruned_at = 0.0
+
+@local_storage_op
+def claim_update(bot: str, update_id: Optional[int]) -> bool:
+    """Record `update_id` for `bot`; False if it was already seen (a redelivery)."""
+    global _dedupe_pruned_at
+    if update_id is None:
+        return True
+    now = int(time.time())
+    try:
+        c = local_db()
+        if now - _dedupe_pruned_at > 60:
+            _dedupe_pruned_at = now
+            c.execute("DELETE FROM seen_updates WHERE seen_at < ?", (now - UPDATE_DEDUPE_WINDOW,))
+        return c.execute("INSERT OR IGNORE INTO seen_updates (bot, update_id, seen_at) VALUES (?, ?, ?)",
+                         (bot, int(update_id), now)).rowcount > 0
+    except Exception:
+        # never drop an update because the dedupe store is unavailable
+        logger.exception("update dedupe check failed")
+        return True
 
+def release_update(bot: str, update_id: Optional[int]):
+    """Forget a claim so Telegram's retry of a failed update is processed."""
+    if update_id is None:
+        return
+    try:
+        local_db().execute("DELETE FROM seen_updates WHERE bot = ? AND update_id = ?", (bot, int(update_id)))
+    except Exception:
+        logger.exception("update dedupe release failed")
+
+def deduped(bot: str, update: dict, process, *args) -> Tuple[Dict[str, Any], int]:
+    """Run `process(*args)` once per update_id; failed runs are released for retry."""
+    update_id = update.get("update_id")
+    if not claim_update(bot, update_id):
+        logger.info("Duplicate update %s for %s ignored", update_id, bot)
+        return {"ok": True, "info": "duplicate"}, 200
+    body, status = process(*args)
+    if status >= 500:
+        release_update(bot, update_id)
+    return body, status
+
+# ----------------- Update processing -----------------
+# Kept free of Flask so the async server (aio_app.py) runs the same code; the
+# process_* functions return (response body, HTTP status).
+WEBHOOK_INLINE_REPLY = os.getenv("WEBHOOK_INLINE_REPLY", "1") == "1"
+
+def split_inline_reply(outbox: Outbox, token: str) -> Tuple[Outbox, Optional[Dict[str, Any]]]:
+    """Pick the call Telegram can run from the webhook response itself.
+
+    Only the last queued call qualifies (Telegram runs it after we answer, so
+    it must not overtake anything), and only if it is for the bot that owns
+    the webhook. Returns (calls to send through the API first, inline body).
+    """
+    if not WEBHOOK_INLINE_REPLY or not outbox or outbox[-1][0] != token:
+        return outbox, None
+    _, method, payload = outbox[-1]
+    # an inline reply cannot wait for its rate-limit slot; if it would have to, send it through the API
+    if "chat_id" in payload and bot_limits.take(token, payload["chat_id"]) > 0:
+        return outbox, None
+    INLINE_REPLIES.labels(method).inc()
+    return outbox[:-1], dict(payload, method=method)
+
+def answer_webhook(token: str, outbox: Outbox, body: Dict[str, Any], status: int) -> Dict[str, Any]:
+    """Send queued calls except the one that can ride on the response; return the body to answer with."""
+    rest, inline = split_inline_reply(outbox, token) if status == 200 else (outbox, None)
+    for tok, method, payload in rest:
+        tg.call(tok, method, payload)
+    return inline or body
+
+def _command_label(update: dict, known) -> str:
+    """Low-cardinality label for WEBHOOK_SECONDS: a known /command, "callback" or "text"."""
+    if update.get("callback_query"):
+        return "callback"
+    message = update.get("message") or update.get("edited_message") or {}
+    cmd = parse_command((message.get("text") or "").strip())
+    return cmd if cmd in known else "text"
+
+def _run_update(kind: str, bot: str, update: dict, known, process, *args) -> Tuple[Dict[str, Any], int]:
+    """deduped() inside a log context for the update; records WEBHOOK_SECONDS and one summary line."""
+    command = _command_label(update, known)
+    with log_context(request_id=uuid.uuid4().hex[:12], bot=bot, command=command, update_id=update.get("update_id")):
+        started = time.perf_counter()
+        status = 500
+        try:
+            body, status = deduped(bot, update, process, *args)
+            return body, status
+        finally:
+            took = time.perf_counter() - started
+            WEBHOOK_SECONDS.labels(kind, command).observe(took)
+            logger.info("Update handled: %s", status, extra={"duration_ms": round(took * 1000, 1)})
+
+def process_main_update(update: dict, outbox: Optional[Outbox] = None) -> Tuple[Dict[str, Any], int]:
+    return _run_update("main", "main", update, COMMANDS, _process_main_update, update, outbox)
+
+def process_user_bot_update(found_key: str, found_rec: dict, update: dict,
+                            outbox: Optional[Outbox] = None) -> Tuple[Dict[str, Any], int]:
+    return _run_update("user", found_key, update, ("/start",),
+                       _process_user_bot_update, found_key, found_rec, update, outbox)
+
+def _process_main_update(update: dict, outbox: Optional[Outbox]) -> Tuple[Dict[str, Any], int]:
+    message = {}
     try:
+        if update.get("callback_query"):
+            handle_callback_query(update["callback_query"], outbox)
+            return {"ok": True}, 200
+
         message = update.get("message") or update.get("edited_message") or {}
-        logger.info(f"📨 Incoming message: {json.dumps(message, ensure_ascii=False)[:300]}")
+        logger.info("📨 Incoming message: %s", LazyJson(message))
 
         if not message:
-            return jsonify({"ok": True, "info": "no-message"})
+            return {"ok": True, "info": "no-message"}, 200
 
-        chat = message.get("chat", {})
-        chat_id = chat.get("id")
-        text = (message.get("text") or "").strip()
-        from_user = message.get("from", {}) or {}
-        user_id = from_user.get("id")
-
-        # Commands handling
-        # /start
-        if text.startswith("/start"):
-            reply = (
-                "Сәлем! ManyBot KZ 🇰🇿\n\n"
-                "Командалар:\n"
-                "/addbot — жаңа бот қосу\n"
-                "/token <TOKEN> — BotFather-дан алынған токенді жіберу (тек жеке чат)\n"
-                "/bots — өз боттарың\n"
-                "/newpost — хабар тарату (ID + мәтін)\n"
-                "/setdescription — бот сипаттамасын орнату\n"
-                "/autoposting — autopost режимін қосу/өшіру\n"
-                "/botlang — боттың тілін орнату\n"
-                "/subscribers — жалпы жазылушылар саны\n"
-                "/templates — шаблондар\n"
-                "/addtemplate — шаблон қосу\n"
-                "/admins — админдер тізімі\n"
-                "/lang — өзіңнің тіл таңдауыңды орнату\n"
-                "/deletebot — ботты өшіру\n"
-                "/help — көмек\n"
-            )
-            if BOT_TOKEN:
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": reply, "parse_mode": "HTML"}, timeout=8)
-            return jsonify({"ok": True})
-
-        if text.startswith("/help"):
-            help_text = (
-                "<b>ManyBot KZ командалары</b>\n"
-                "/addbot — жаңа бот қосу (private чатта /token жібер)\n"
-                "/token <TOKEN> — токен жіберу\n"
-                "/bots — өз боттарыңызды көру\n"
-                "/deletebot <DB_KEY> — ботты өшіру\n"
-                "/newpost — хабар тарату (бір хабарда: DB_KEY\\nМӘТІН)\n"
-                "/setdescription — бот сипаттамасын орнату (бір хабарда: /setdescription\\nDB_KEY\\nDESCRIPTION)\n"
-                "/autoposting — қосу/өшіру (бір хабарда: /autoposting\\nDB_KEY\\non|off)\n"
-                "/botlang — бот тілін орнату (мысалы: /botlang DB_KEY kk|ru|en)\n"
-                "/subscribers — жазылушылар саны\n"
-                "/admins — админдер тізімі (тізім көрсету)\n"
-                "/lang — өз тіл таңдауыңды орнату (мысалы: /lang kk)\n"
-                "/addtemplate — шаблон қосу (бір хабарда: /addtemplate\\nTITLE\\nCONTENT)\n"
-                "/templates — менің шаблондар\n"
-            )
-            if BOT_TOKEN:
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": help_text, "parse_mode": "HTML"}, timeout=8)
-            return jsonify({"ok": True})
-
-        if text.startswith("/addbot"):
-            msg = "Bot қосу: BotFather арқылы бот жасаңыз да, жеке чатта төмендегі командамен токенді жіберіңіз:\n\n/token <BOT_TOKEN>"
-            requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                          json={"chat_id": chat_id, "text": msg}, timeout=8)
-            return jsonify({"ok": True})
-
-        # token handler (only in private)
-        if text.startswith("/token "):
-            if chat.get("type") != "private":
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": "Токенді тек жеке чатта жіберіңіз."}, timeout=8)
-                return jsonify({"ok": True})
-            token = text.split(" ", 1)[1].strip()
-            if ":" not in token:
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": "Токен форматы қате."}, timeout=8)
-                return jsonify({"ok": True})
-            requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                          json={"chat_id": chat_id, "text": "Токен тексерілуде..."}, timeout=8)
-            me = get_me(token)
-            if not me:
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": "Токен жарамсыз немесе Telegram қол жетімсіз."}, timeout=8)
-                return jsonify({"ok": True})
-            # save bot
-            key = save_bot_record(owner=user_id, bot_id=me.get("id"), username=me.get("username"), token_plain=token)
-            # set webhook for user bot to our /u/<owner>_<botid>
-            webhook_url = None
-            if WEBHOOK_BASE_URL:
-                webhook_url = f"{WEBHOOK_BASE_URL}/u/{user_id}_{me.get('id')}"
-                set_res = set_webhook_for_token(token, webhook_url)
-                logger.info("Set webhook for user bot result: %s", set_res)
-            # reply
-            reply = f"✅ @{me.get('username')} қосылды!\nDB_KEY: {key}"
-            if webhook_url:
-                reply += f"\nWebhook: {webhook_url}"
-            requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                          json={"chat_id": chat_id, "text": reply}, timeout=8)
-            return jsonify({"ok": True})
-
-        # /bots - show user's bots
-        if text.startswith("/bots"):
-            all_bots = get_all_bots() or {}
-            my = []
-            for k, v in (all_bots.items() if isinstance(all_bots, dict) else []):
-                if int(v.get("owner", 0)) == int(user_id):
-                    my.append((k, v))
-            if not my:
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": "Сіздің қосқан ботыңыз жоқ."}, timeout=8)
-                return jsonify({"ok": True})
-            out = "Сіздің боттарыңыз:\n\n"
-            for k, v in my:
-                out += f"DB_KEY: <code>{k}</code>\n@{v.get('username','')}\nОписание: {v.get('description','')}\nАвто: {v.get('autopost_enabled', False)}\nЯзык: {v.get('bot_lang','kk')}\n\n"
-            requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                          json={"chat_id": chat_id, "text": out, "parse_mode": "HTML"}, timeout=8)
-            return jsonify({"ok": True})
-
-        # /deletebot <key>
-        if text.startswith("/deletebot"):
-            parts = text.split()
-            if len(parts) < 2:
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": "Қолдану: /deletebot <DB_KEY>"}, timeout=8)
-                return jsonify({"ok": True})
-            key = parts[1].strip()
-            rec = get_bot_by_key(key)
-            if not rec:
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": "Бот табылмады."}, timeout=8)
-                return jsonify({"ok": True})
-            if int(rec.get("owner")) != int(user_id) and not is_admin(user_id):
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": "Бұл бот сізге тиесілі емес."}, timeout=8)
-                return jsonify({"ok": True})
-            # try delete webhook
-            try:
-                token_enc = rec.get("token")
-                token = decrypt_token(token_enc) if fernet else token_enc
-                delete_webhook_for_token(token)
-            except Exception:
-                logger.exception("delete webhook attempt failed")
-            delete_bot_by_key(key)
-            requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                          json={"chat_id": chat_id, "text": "✅ Бот жойылды."}, timeout=8)
-            return jsonify({"ok": True})
-
-        # /newpost - explanation
-        if text.startswith("/newpost"):
-            msg = "Хабар тарату үшін бір хабарда келесі форматты жіберіңіз:\n<DB_KEY>\n<мәтін>"
-            requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                          json={"chat_id": chat_id, "text": msg}, timeout=8)
-            return jsonify({"ok": True})
-
-        # /setdescription - set bot description
-        if text.startswith("/setdescription"):
-            # expected format: /setdescription\n<DB_KEY>\n<DESCRIPTION>
-            if "\n" in text:
-                parts = text.split("\n", 2)
-                if len(parts) >= 3:
-                    _, db_key, desc = parts
-                    rec = get_bot_by_key(db_key.strip())
-                    if not rec:
-                        requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                                      json={"chat_id": chat_id, "text": "DB_KEY табылмады."}, timeout=8)
-                        return jsonify({"ok": True})
-                    if int(rec.get("owner")) != int(user_id) and not is_admin(user_id):
-                        requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                                      json={"chat_id": chat_id, "text": "Сіз бұл боттың иесі емессіз."}, timeout=8)
-                        return jsonify({"ok": True})
-                    update_bot_field(db_key.strip(), "description", desc.strip())
-                    requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                                  json={"chat_id": chat_id, "text": "✅ Сипаттама сақталды."}, timeout=8)
-                    return jsonify({"ok": True})
-            # usage
-            requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                          json={"chat_id": chat_id, "text": "Қолдану:\n/setdescription\n<DB_KEY>\n<DESCRIPTION>"}, timeout=8)
-            return jsonify({"ok": True})
-
-        # /autoposting - enable/disable autopost for bot
-        if text.startswith("/autoposting"):
-            # expected format: /autoposting\n<DB_KEY>\n<on|off>
-            if "\n" in text:
-                parts = text.split("\n", 2)
-                if len(parts) >= 3:
-                    _, db_key, flag = parts
-                    flag = flag.strip().lower()
-                    rec = get_bot_by_key(db_key.strip())
-                    if not rec:
-                        requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                                      json={"chat_id": chat_id, "text": "DB_KEY табылмады."}, timeout=8)
-                        return jsonify({"ok": True})
-                    if int(rec.get("owner")) != int(user_id) and not is_admin(user_id):
-                        requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                                      json={"chat_id": chat_id, "text": "Сіз бұл боттың иесі емессіз."}, timeout=8)
-                        return jsonify({"ok": True})
-                    if flag in ("on", "enable", "true", "1"):
-                        update_bot_field(db_key.strip(), "autopost_enabled", True)
-                        requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                                      json={"chat_id": chat_id, "text": "✅ Autopost қосылды."}, timeout=8)
-                    elif flag in ("off", "disable", "false", "0"):
-                        update_bot_field(db_key.strip(), "autopost_enabled", False)
-                        requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                                      json={"chat_id": chat_id, "text": "✅ Autopost өшірілді."}, timeout=8)
-                    else:
-                        requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                                      json={"chat_id": chat_id, "text": "Қолдану: /autoposting\\n<DB_KEY>\\n<on|off>"}, timeout=8)
-                    return jsonify({"ok": True})
-            requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                          json={"chat_id": chat_id, "text": "Қолдану:\n/autoposting\n<DB_KEY>\n<on|off>"}, timeout=8)
-            return jsonify({"ok": True})
-
-        # /botlang - set per-bot language
-        if text.startswith("/botlang"):
-            # usage: /botlang <DB_KEY> <kk|ru|en>
-            parts = text.split()
-            if len(parts) >= 3:
-                db_key = parts[1].strip()
-                lang = parts[2].strip().lower()
-                if lang not in ("kk", "ru", "en"):
-                    requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                                  json={"chat_id": chat_id, "text": "Қолдау көрсетілетін тілдер: kk, ru, en."}, timeout=8)
-                    return jsonify({"ok": True})
-                rec = get_bot_by_key(db_key)
-                if not rec:
-                    requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                                  json={"chat_id": chat_id, "text": "DB_KEY табылмады."}, timeout=8)
-                    return jsonify({"ok": True})
-                if int(rec.get("owner")) != int(user_id) and not is_admin(user_id):
-                    requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                                  json={"chat_id": chat_id, "text": "Сіз бұл боттың иесі емессіз."}, timeout=8)
-                    return jsonify({"ok": True})
-                update_bot_field(db_key, "bot_lang", lang)
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": f"✅ Боттың тілі {lang} етіп орнатылды."}, timeout=8)
-                return jsonify({"ok": True})
-            # usage
-            requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                          json={"chat_id": chat_id, "text": "Қолдану: /botlang <DB_KEY> <kk|ru|en>"}, timeout=8)
-            return jsonify({"ok": True})
-
-        # /admins - list admins (only for admins or show limited)
-        if text.startswith("/admins"):
-            admins = list_admins()
-            if not admins:
-                text_out = "Админдер тізімі бос."
-            else:
-                text_out = "Админдер:\n" + "\n".join([str(a) for a in admins])
-            requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                          json={"chat_id": chat_id, "text": text_out}, timeout=8)
-            return jsonify({"ok": True})
-
-        # /lang - set user's preferred language for ManyBot responses
-        if text.startswith("/lang"):
-            parts = text.split()
-            if len(parts) >= 2:
-                lang = parts[1].strip().lower()
-                if lang not in ("kk", "ru", "en"):
-                    requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                                  json={"chat_id": chat_id, "text": "Қолдау көрсетілетін тілдер: kk, ru, en."}, timeout=8)
-                    return jsonify({"ok": True})
-                set_user_pref(user_id, "lang", lang)
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": f"✅ Тіліңіз {lang} етіп орнатылды."}, timeout=8)
-                return jsonify({"ok": True})
-            # show current
-            cur = get_user_pref(user_id, "lang", "kk")
-            requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                          json={"chat_id": chat_id, "text": f"Сіздің қазіргі тіліңіз: {cur}"}, timeout=8)
-            return jsonify({"ok": True})
-
-        # /subscribers count
-        if text.startswith("/subscribers"):
-            total = count_total_subscribers()
-            requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                          json={"chat_id": chat_id, "text": f"Барлығы: {total}"}, timeout=8)
-            return jsonify({"ok": True})
-
-        # Broadcast heuristic: message contains newline and first line looks like DB_KEY
-        if "\n" in text:
-            first, rest = text.split("\n", 1)
-            first = first.strip()
-            if len(first) >= 8:  # crude check for DB_KEY
-                rec = get_bot_by_key(first)
-                if rec:
-                    if int(rec.get("owner")) != int(user_id) and not is_admin(user_id):
-                        requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                                      json={"chat_id": chat_id, "text": "Сіз бұл боттың иесі емессіз."}, timeout=8)
-                        return jsonify({"ok": True})
-                    tok_enc = rec.get("token")
-                    try:
-                        tok = decrypt_token(tok_enc) if fernet else tok_enc
-                    except Exception:
-                        requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                                      json={"chat_id": chat_id, "text": "Токенді дешифрлеу сәтсіз."}, timeout=8)
-                        return jsonify({"ok": True})
-                    subs = get_subscribers(first)
-                    sent = 0
-                    for uid in subs:
-                        try:
-                            send_message_with_token(tok, int(uid), rest)
-                            sent += 1
-                        except Exception:
-                            continue
-                    requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                                  json={"chat_id": chat_id, "text": f"✅ {sent} адамға жіберілді."}, timeout=8)
-                    return jsonify({"ok": True})
-
-        # templates
-        if text.startswith("/addtemplate"):
-            # accept multiline message after command
-            if "\n" in text:
-                _, rest = text.split("\n", 1)
-                if "\n" in rest:
-                    title, content = rest.split("\n", 1)
-                else:
-                    title = rest.strip(); content = ""
-                save_template(user_id, title.strip() or "Без названия", content.strip())
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": "✅ Шаблон сақталды."}, timeout=8)
-            else:
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": "Қолдану: /addtemplate\\n<TITLE>\\n<CONTENT>"}, timeout=8)
-            return jsonify({"ok": True})
-
-        if text.startswith("/templates"):
-            temps = get_templates(user_id)
-            if not temps:
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": "Шаблондар жоқ."}, timeout=8)
-            else:
-                out = ""
-                for k, v in temps.items():
-                    out += f"ID:{k}\n{v.get('title')}\n{v.get('content')}\n\n"
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": out[:4000]}, timeout=8)
-            return jsonify({"ok": True})
-
-        # admin add/remove (existing)
-        if text.startswith("/addadmin"):
-            if not is_admin(user_id):
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": "Сіз админ емессіз."}, timeout=8)
-                return jsonify({"ok": True})
-            parts = text.split()
-            if len(parts) < 2:
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": "Қолдану: /addadmin <user_id>"}, timeout=8)
-                return jsonify({"ok": True})
-            try:
-                new_id = int(parts[1])
-                add_admin(new_id)
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": f"✅ {new_id} админ етілді."}, timeout=8)
-            except:
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": "Қате user_id."}, timeout=8)
-            return jsonify({"ok": True})
-
-        if text.startswith("/removeadmin"):
-            if not is_admin(user_id):
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": "Сіз админ емессіз."}, timeout=8)
-                return jsonify({"ok": True})
-            parts = text.split()
-            if len(parts) < 2:
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": "Қолдану: /removeadmin <user_id>"}, timeout=8)
-                return jsonify({"ok": True})
-            try:
-                rem = int(parts[1])
-                remove_admin(rem)
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": f"✅ {rem} админдер тізімінен алынды."}, timeout=8)
-            except:
-                requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                              json={"chat_id": chat_id, "text": "Қате user_id."}, timeout=8)
-            return jsonify({"ok": True})
+        ctx = CommandContext(message, outbox)
+        handler = COMMANDS.get(ctx.command) if ctx.command else None
+        if handler:
+            handler(ctx)
+            return {"ok": True}, 200
+        if handle_db_key_broadcast(ctx):
+            return {"ok": True}, 200
 
     except Exception as e:
         logger.exception("Main webhook handler exception: %s", e)
         # try to notify admin
         try:
-            requests.post(telegram_api_url(BOT_TOKEN, "sendMessage"),
-                          json={"chat_id": chat_id if 'chat_id' in locals() else 0,
-                                "text": "Серверде қате пайда болды. Админге хабарлаңыз."}, timeout=8)
+            send_main_message((message.get("chat") or {}).get("id") or 0, "Серверде қате пайда болды. Админге хабарлаңыз.")
         except Exception:
             pass
-        return jsonify({"ok": False, "error": "exception"}), 500
+        return {"ok": False, "error": "exception"}, 500
 
-    return jsonify({"ok": True, "info": "unhandled"})
-
-# ----------------- User bot webhook endpoint -----------------
-# For each user bot, webhook should be set to: {WEBHOOK_BASE_URL}/u/{owner}_{botid}
-@app.route("/u/<owner_bot>", methods=["POST"])
-def user_bot_webhook(owner_bot: str):
-    payload = request.get_json(silent=True)
-    if not payload:
-        return jsonify({"ok": False, "error": "invalid json"}), 400
-    # owner_bot like "12345_987654321"
-    if "_" not in owner_bot:
-        return jsonify({"ok": False, "error": "bad path"}), 400
-    owner_str, botid_str = owner_bot.split("_", 1)
-    # find bot record
-    all_bots = get_all_bots() or {}
-    found_key = None; found_rec = None
-    for k, v in (all_bots.items() if isinstance(all_bots, dict) else []):
-        if str(v.get("owner")) == owner_str and str(v.get("bot_id")) == botid_str:
-            found_key = k; found_rec = v; break
-    if not found_rec:
-        logger.warning("Webhook for unknown user-bot: %s", owner_bot)
-        return jsonify({"ok": False, "error": "unknown bot"}), 404
+    return {"ok": True, "info": "unhandled"}, 200
 
+def _process_user_bot_update(found_key: str, found_rec: dict, update: dict,
+                             outbox: Optional[Outbox]) -> Tuple[Dict[str, Any], int]:
     try:
-        message = payload.get("message") or payload.get("edited_message") or {}
+        message = update.get("message") or update.get("edited_message") or {}
         if not message:
-            return jsonify({"ok": True, "info": "no-message"})
+            return {"ok": True, "info": "no-message"}, 200
         text = (message.get("text") or "").strip()
         chat = message.get("chat", {})
         chat_id = chat.get("id")
         # register subscriber on /start
         if isinstance(text, str) and text.lower().startswith("/start"):
-            add_subscriber(found_key, chat_id)
+            register_subscriber(found_key, chat_id)
             # greet via user bot token
-            token_enc = found_rec.get("token")
             try:
-                token = decrypt_token(token_enc) if fernet else token_enc
+                token = bot_token(found_key, found_rec)
             except Exception:
-                token = token_enc
+                token = found_rec.get("token")
             try:
-                send_message_with_token(token, chat_id, "Сіз осы ботқа жазылдыңыз! Қош келдіңіз ✅")
+                deliver(outbox, token, "sendMessage",
+                        {"chat_id": chat_id, "text": "Сіз осы ботқа жазылдыңыз! Қош келдіңіз ✅", "parse_mode": "HTML"})
             except Exception:
                 logger.exception("Greeting send failed")
-            return jsonify({"ok": True})
+            return {"ok": True}, 200
         # Optionally: you can add auto-replies or collect commands from user-bot messages here
     except Exception:
         logger.exception("user_bot_webhook processing error: %s", traceback.format_exc())
-        return jsonify({"ok": False, "error": "exception"}), 500
+        return {"ok": False, "error": "exception"}, 500
+
+    return {"ok": True}, 200
+
+# For each user bot, webhook is set to: {WEBHOOK_BASE_URL}/b/{DB_KEY} with a secret_token.
+# Bots registered before that still post to the legacy {WEBHOOK_BASE_URL}/u/{owner}_{botid}.
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+def _secret_ok(key: str, got: Optional[str], required: bool) -> bool:
+    if got is None:
+        return not required
+    return hmac.compare_digest(got, webhook_secret(key))
+
+def resolve_user_bot(bot_key: Optional[str], owner_bot: Optional[str], secret: Optional[str]) -> tuple:
+    """Map a /b/<bot_key> or legacy /u/<owner_bot> webhook to (key, rec, error).
+
+    `error` is None on success, else the (body, status) to answer with.
+    """
+    if bot_key is not None:
+        if not _secret_ok(bot_key, secret, required=True):
+            return None, None, ({"ok": False, "error": "forbidden"}, 403)
+        rec = get_bot_by_key(bot_key)
+        if not rec:
+            logger.warning("Webhook for unknown user-bot key: %s", bot_key)
+            return None, None, ({"ok": False, "error": "unknown bot"}, 404)
+        return bot_key, rec, None
+    # owner_bot like "12345_987654321"
+    if "_" not in (owner_bot or ""):
+        return None, None, ({"ok": False, "error": "bad path"}, 400)
+    found_key = resolve_legacy_route(owner_bot)
+    found_rec = get_bot_by_key(found_key) if found_key else None
+    if not found_rec:
+        _bot_route_index.pop(owner_bot, None)
+        logger.warning("Webhook for unknown user-bot: %s", owner_bot)
+        return None, None, ({"ok": False, "error": "unknown bot"}, 404)
+    if not _secret_ok(found_key, secret, required=False):
+        return None, None, ({"ok": False, "error": "forbidden"}, 403)
+    return found_key, found_rec, None
 
-    return jsonify({"ok": True})
+# ----------------- Flask app & routes -----------------
+app = Flask(__name__)
+
+@app.route("/", methods=["GET"])
+def root():
+    return "✅ ManyBot KZ running"
+
+def metrics_allowed(auth_header: Optional[str]) -> bool:
+    return not METRICS_TOKEN or hmac.compare_digest(auth_header or "", f"Bearer {METRICS_TOKEN}")
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    if not metrics_allowed(request.headers.get("Authorization")):
+        return "forbidden", 403
+    data = render_metrics()
+    if data is None:
+        return "prometheus_client is not installed", 501
+    return data, 200, {"Content-Type": CONTENT_TYPE_LATEST}
+
+# Main bot webhook - ManyBot main receives updates here
+@app.route(f"/{BOT_TOKEN}", methods=["POST"])
+def main_bot_webhook():
+    # This endpoint is where Telegram posts updates for the MAIN ManyBot (BOT_TOKEN)
+    update = request.get_json(silent=True)
+    if not update:
+        return jsonify({"ok": False, "error": "invalid json"}), 400
+    outbox: Outbox = []
+    body, status = process_main_update(update, outbox)
+    return jsonify(answer_webhook(BOT_TOKEN, outbox, body, status)), status
+
+# ----------------- User bot webhook endpoint -----------------
+@app.route("/b/<bot_key>", methods=["POST"])
+def user_bot_keyed_webhook(bot_key: str):
+    key, rec, err = resolve_user_bot(bot_key, None, request.headers.get(SECRET_HEADER))
+    if err:
+        return jsonify(err[0]), err[1]
+    return _handle_user_bot_update(key, rec)
+
+@app.route("/u/<owner_bot>", methods=["POST"])
+def user_bot_webhook(owner_bot: str):
+    key, rec, err = resolve_user_bot(None, owner_bot, request.headers.get(SECRET_HEADER))
+    if err:
+        return jsonify(err[0]), err[1]
+    return _handle_user_bot_update(key, rec)
+
+def _handle_user_bot_update(found_key: str, found_rec: dict):
+    payload = request.get_json(silent=True)
+    if not payload:
+        return jsonify({"ok": False, "error": "invalid json"}), 400
+    outbox: Outbox = []
+    body, status = process_user_bot_update(found_key, found_rec, payload, outbox)
+    # everything queued for a user-bot update is sent with that bot's own token
+    token = outbox[-1][0] if outbox else ""
+    return jsonify(answer_webhook(token, outbox, body, status)), status
 
 # ----------------- utility: set main webhook -----------------
-def set_main_webhook():
+# Registration is a one-time step, not import work: `flask --app main set-webhook`
+# runs it, by hand or from gunicorn.conf.py (when_ready) once per deploy.
+# A file lock keeps concurrent callers on one host from racing each other.
+WEBHOOK_LOCK_PATH = os.getenv("WEBHOOK_LOCK_PATH", os.path.join(tempfile.gettempdir(), "manybot-webhook.lock"))
+
+def main_webhook_url() -> Optional[str]:
     if not BOT_TOKEN or not WEBHOOK_BASE_URL:
+        return None
+    return f"{WEBHOOK_BASE_URL}/{BOT_TOKEN}"
+
+def set_main_webhook():
+    url = main_webhook_url()
+    if not url:
         logger.info("set_main_webhook skipped (BOT_TOKEN or WEBHOOK_BASE_URL missing)")
         return
-    url = f"{WEBHOOK_BASE_URL}/{BOT_TOKEN}"
     try:
-        r = requests.post(telegram_api_url(BOT_TOKEN, "setWebhook"), json={"url": url}, timeout=8).json()
+        r = set_webhook_for_token(BOT_TOKEN, url)
         logger.info("Set main webhook result: %s", r)
     except Exception:
         logger.exception("set_main_webhook failed")
 
-# Run startup: try set webhook
-try:
-    if WEBHOOK_BASE_URL and BOT_TOKEN:
-        logger.info("Attempting to set main webhook...")
+def ensure_main_webhook() -> bool:
+    """Point the main bot's webhook at us unless it already is. Returns True if it was set."""
+    url = main_webhook_url()
+    if not url:
+        logger.info("ensure_main_webhook skipped (BOT_TOKEN or WEBHOOK_BASE_URL missing)")
+        return False
+    with open(WEBHOOK_LOCK_PATH, "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            logger.info("Main webhook is being set by another process")
+            return False
+        info = tg.call(BOT_TOKEN, "getWebhookInfo")
+        if info.get("ok") and (info.get("result") or {}).get("url") == url:
+            logger.info("Main webhook already set")
+            return False
         set_main_webhook()
-except Exception:
-    logger.exception("startup set_main_webhook error")
+        return True
+
+# ----------------- user-bot webhook reconciliation -----------------
+# User-bot webhooks are otherwise only set by /token, so a new WEBHOOK_BASE_URL
+# or a webhook dropped by Telegram would silence bots until owners re-register.
+RECONCILE_WORKERS = int(os.getenv("RECONCILE_WORKERS", "16"))
+RECONCILE_RATE = float(os.getenv("RECONCILE_RATE", "30"))              # Bot API calls/sec, all bots
+RECONCILE_ERROR_WINDOW = int(os.getenv("RECONCILE_ERROR_WINDOW", "3600"))  # re-set after a recent delivery error
+USER_BOT_ALLOWED_UPDATES = ["message", "edited_message"]
+
+def user_bot_webhook_url(key: str) -> str:
+    return f"{WEBHOOK_BASE_URL}/b/{key}"
+
+def webhook_drift(info: Dict[str, Any], url: str) -> Optional[str]:
+    """Why a getWebhookInfo result needs a new setWebhook, or None if it matches."""
+    if info.get("url") != url:
+        return "url"
+    if sorted(info.get("allowed_updates") or []) != sorted(USER_BOT_ALLOWED_UPDATES):
+        return "allowed_updates"
+    last_error = info.get("last_error_date")
+    if last_error and time.time() - last_error < RECONCILE_ERROR_WINDOW:
+        return "error"
+    return None
+
+def reconcile_bot_webhook(key: str, rec: dict, limiter: RateLimiter) -> str:
+    """Check one bot and fix its webhook. Returns the outcome name used in the summary."""
     try:
-        info = requests.get(telegram_api_url(BOT_TOKEN, "getWebhookInfo")).json()
-        logger.info(f"Webhook info: {json.dumps(info, ensure_ascii=False, indent=2)}")
+        token = bot_token(key, rec)
     except Exception:
-        pass
+        return "bad_token"
+    info = _paced_call(limiter, token, "getWebhookInfo")
+    if not info.get("ok"):
+        return "unauthorized" if info.get("error_code") == 401 else "failed"
+    url = user_bot_webhook_url(key)
+    reason = webhook_drift(info.get("result") or {}, url)
+    if reason is None:
+        return "ok"
+    res = _paced_call(limiter, token, "setWebhook", {
+        "url": url, "secret_token": webhook_secret(key), "allowed_updates": USER_BOT_ALLOWED_UPDATES})
+    if not res.get("ok"):
+        logger.warning("setWebhook for %s failed: %s", key, res)
+        return "failed"
+    return f"fixed_{reason}"
+
+def reconcile_webhooks(workers: int = RECONCILE_WORKERS, rate: float = RECONCILE_RATE) -> Dict[str, Any]:
+    """Compare every user bot's webhook with what it should be and re-set the drifted ones.
+
+    Bots are read page by page and checked on a bounded pool sharing one
+    RateLimiter. Bots still on the legacy /u/ path are moved to /b/<key>.
+    """
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("WEBHOOK_BASE_URL is not configured")
+    stats: Dict[str, Any] = {"checked": 0}
+    lock = threading.Lock()
+    limiter = RateLimiter(rate)
+    window = threading.BoundedSemaphore(workers * 2)
+    started = time.monotonic()
+
+    def run(key: str, rec: dict):
+        try:
+            outcome = reconcile_bot_webhook(key, rec, limiter)
+        except Exception:
+            logger.exception("webhook reconcile for %s failed", key)
+            outcome = "failed"
+        finally:
+            window.release()
+        with lock:
+            stats[outcome] = stats.get(outcome, 0) + 1
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="reconcile") as pool:
+        for page in iter_bot_pages():
+            for key, rec in page:
+                if not isinstance(rec, dict):
+                    continue
+                stats["checked"] += 1
+                window.acquire()
+                pool.submit(run, key, rec)
+    stats["elapsed"] = round(time.monotonic() - started, 2)
+    logger.info("Webhook reconcile finished: %s", stats)
+    return stats
+
+@app.cli.command("reconcile-webhooks")
+def reconcile_webhooks_command():
+    """Re-set user-bot webhooks whose URL, allowed_updates or error state has drifted."""
+    stats = reconcile_webhooks()
+    print(", ".join(f"{k}={v}" for k, v in stats.items()))
+
+@app.cli.command("set-webhook")
+def set_webhook_command():
+    """Register the main bot webhook (no-op when getWebhookInfo already matches)."""
+    print("Webhook set." if ensure_main_webhook() else "Webhook unchanged.")
+
+@app.cli.command("build-owner-index")
+def build_owner_index_command():
+    """One-off migration: index existing bots under bots_by_owner/<owner>/<key>."""
+    n = build_owner_index()
+    print(f"Indexed {n} bots.")
+
+@app.cli.command("build-template-index")
+def build_template_index_command():
+    """One-off migration: index existing templates under templates_by_owner/<owner>/<key>."""
+    n = build_template_index()
+    print(f"Indexed {n} templates.")
+
+@app.cli.command("build-autopost-index")
+def build_autopost_index_command():
+    """One-off migration: index bots that autopost under autopost_index/<key>."""
+    n = build_autopost_index()
+    print(f"Indexed {n} autoposting bots.")
+
+@app.cli.command("recount-subscribers")
+def recount_subscribers_command():
+    """Repair subscriber_counts and stats/subscribers_total from the subscribers tree."""
+    counts = recount_subscribers()
+    print(f"Recounted {len(counts)} bots, {sum(counts.values())} subscribers.")
+
+@app.cli.command("import-local-json")
+def import_local_json_command():
+    """Import legacy local_db/*.json files into the SQLite store (existing rows win)."""
+    print(f"Imported {import_local_json()} records into {LOCAL_DB_PATH}.")
+
+@app.cli.command("rotate-tokens")
+def rotate_tokens_command():
+    """Re-encrypt all stored bot tokens with the first MASTER_KEY, in batches."""
+    stats = reencrypt_tokens()
+    print(f"Re-encrypted {stats['rotated']} tokens, {stats['failed']} could not be decrypted.")
+
+@app.cli.command("autopost-scheduler")
+def autopost_scheduler_command():
+    """Run the autopost scheduler in the foreground (AUTOPOST_MODE=external)."""
+    run_autopost_scheduler()
+
+@app.cli.command("broadcast-worker")
+def broadcast_worker_command():
+    """Run the broadcast job worker in the foreground (BROADCAST_WORKER_MODE=external)."""
+    run_broadcast_worker()
+
+# Inline workers start with the first request rather than at import, so CLI
+# commands and the gunicorn master do not spawn one.
+@app.before_request
+def _start_background_work():
+    start_background_work()
+
+logger.info("main.py imported in %.1f ms", (time.perf_counter() - _IMPORT_STARTED) * 1000)
 
 # ------------- Run Flask -------------
 if __name__ == "__main__":
     logger.info("ManyBot KZ starting (Flask). Port: %s", PORT)
+    ensure_main_webhook()
     app.run(host="0.0.0.0", port=PORT, debug=True)
@@ -0,0 +1,50 @@
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("BOT_TOKEN", "1:TEST")
+os.environ.setdefault("LOCAL_DB_DIR", tempfile.mkdtemp(prefix="manybot-test-"))
+os.environ.setdefault("FIREBASE_ENABLED", "0")
+os.environ.setdefault("BROADCAST_WORKER_MODE", "external")
+os.environ.setdefault("AUTOPOST_MODE", "off")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+# Firebase's key order for these ids: keys that parse as 32-bit integers come first,
+# numerically; longer ids follow as strings, lexicographically
+FIREBASE_ORDER = ["42", "123456789", "999999999", "1234567890", "2000000000", "5000000000", "7123456789"]
+
+class FakeSubsQuery:
+    """order_by_key() query over one bot's subscribers, answering the way firebase_admin does:
+    the server pages in key order, the SDK hands the page back sorted as plain strings."""
+
+    def __init__(self, keys, start=None, limit=None):
+        self.keys, self.start, self.limit = keys, start, limit
+
+    def child(self, bot_key):
+        return self
+
+    def order_by_key(self):
+        return self
+
+    def start_at(self, key):
+        return FakeSubsQuery(self.keys, key, self.limit)
+
+    def limit_to_first(self, n):
+        return FakeSubsQuery(self.keys, self.start, n)
+
+    def get(self):
+        keys = sorted(self.keys, key=FIREBASE_ORDER.index)
+        if self.start is not None:
+            keys = keys[keys.index(self.start):]
+        return {k: True for k in sorted(keys[:self.limit])}
+
+def test_firebase_pages_follow_key_order_with_mixed_length_ids(monkeypatch):
+    monkeypatch.setattr(main, "firebase_ready", lambda: True)
+    monkeypatch.setattr(main, "SUBS_REF", FakeSubsQuery(list(reversed(FIREBASE_ORDER))))
+    seen = list(main.iter_subscribers("bot", page=3))
+    assert seen == [int(k) for k in FIREBASE_ORDER]
+    # resuming behind any checkpoint yields exactly the ids not sent yet
+    for n in range(1, len(seen)):
+        assert list(main.iter_subscribers("bot", after=seen[n - 1], page=3)) == seen[n:]